@@ -0,0 +1,84 @@
+# bench_memory.py — сколько памяти занимает очередь публикаций: MediaItem/Payload (slots)
+# против прежних dict-элементов и кортежей. Строки file_id общие для обоих вариантов, поэтому
+# меряется только то, что добавляет само представление.
+#
+#   python bench_memory.py                 # 100k кадров (10k альбомов по 10)
+#   python bench_memory.py --items 500000
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("OCR_ENABLED", "0")
+
+import bot  # noqa: E402
+
+ALBUM = 10
+
+def raw_frames(n: int) -> List[Tuple[int, str, str, Tuple[Tuple[str, int, int], ...]]]:
+    """(mid, file_id, file_unique_id, sizes) — как их отдаёт Telegram, без нашей обёртки."""
+    out = []
+    for i in range(n):
+        fid = f"AgACAgIAAxkBAAI{i:012d}" + "x" * 48
+        sizes = ((fid[:-2] + "s0", 90, 90), (fid[:-2] + "m0", 320, 320), (fid, 1280, 1280))
+        out.append((100000 + i, fid, f"AQAD{i:012d}", sizes))
+    return out
+
+# ---------- прежнее представление ----------
+def legacy_items(frames) -> List[Dict[str, Any]]:
+    return [{"kind": "photo", "fid": fid, "uid": uid, "mid": mid, "cap": False, "sizes": sizes}
+            for mid, fid, uid, sizes in frames]
+
+def legacy_payloads(items: List[Dict[str, Any]]) -> List[tuple]:
+    return [(items[i]["mid"], -100, items[i]["mid"], 7, items[i:i + ALBUM], "", True, 0.0, "", "")
+            for i in range(0, len(items), ALBUM)]
+
+# ---------- текущее ----------
+def slotted_items(frames) -> List["bot.MediaItem"]:
+    photo = bot.MediaKind.PHOTO
+    return [bot.MediaItem(photo, mid, fid=fid, uid=uid, sizes=sizes) for mid, fid, uid, sizes in frames]
+
+def slotted_payloads(items: List["bot.MediaItem"]) -> List["bot.Payload"]:
+    return [bot.Payload(items[i].mid, -100, items[i].mid, 7, tuple(items[i:i + ALBUM]), "", True, 0.0, "", "")
+            for i in range(0, len(items), ALBUM)]
+
+def measure(build: Callable[..., Any], *args: Any) -> Tuple[int, float, Any]:
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    obj = build(*args)
+    elapsed = time.perf_counter() - t0
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used, elapsed, obj
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Память на кадр/публикацию в очереди")
+    ap.add_argument("--items", type=int, default=100_000, help="кадров в очереди")
+    args = ap.parse_args(argv)
+
+    frames = raw_frames(args.items)
+    n_payloads = (args.items + ALBUM - 1) // ALBUM
+    rows = []
+    for name, make_items, make_payloads in (
+        ("dict + tuple", legacy_items, legacy_payloads),
+        ("MediaItem + Payload", slotted_items, slotted_payloads),
+    ):
+        items_bytes, items_s, items = measure(make_items, frames)
+        pl_bytes, pl_s, payloads = measure(make_payloads, items)
+        rows.append((name, items_bytes / args.items, pl_bytes / n_payloads,
+                     (items_bytes + pl_bytes) / 1024 / 1024, (items_s + pl_s) * 1000))
+        del items, payloads
+
+    print(f"Очередь: {args.items} кадров, {n_payloads} публикаций по {ALBUM}\n")
+    print(f"{'представление':<22}{'байт/кадр':>11}{'байт/публ.':>12}{'всего МБ':>10}{'сборка мс':>11}")
+    for name, per_item, per_pl, total_mb, ms in rows:
+        print(f"{name:<22}{per_item:>11.0f}{per_pl:>12.0f}{total_mb:>10.1f}{ms:>11.0f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+# bench_parser.py — микробенчмарк разбора подписей и расчёта цен на корпусе реальных подписей
+# (bench_captions.jsonl, анонимизировано) + сверка с эталоном, чтобы ускорение не меняло цены.
+#
+#   python bench_parser.py                  # замер + сверка с bench_golden.json
+#   python bench_parser.py --rounds 50      # больше прогонов — стабильнее перцентили
+#   python bench_parser.py --only parse_input
+#   python bench_parser.py --update-golden  # осознанно принять новые результаты как эталон
+
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Callable, Dict, List, Tuple
+
+# bot.py создаёт Bot при импорте — для офлайн-замеров хватит фиктивного токена
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("OCR_ENABLED", "0")
+
+import bot  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(HERE, "bench_captions.jsonl")
+GOLDEN_PATH = os.path.join(HERE, "bench_golden.json")
+BENCH_USER = 0  # условный пользователь, режим задаётся через bot.active_mode
+GOLDEN_MODES = ("sale", "lux")
+
+def load_corpus(path: str = CORPUS_PATH) -> List[Dict[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def money_tokens(corpus: List[Dict[str, str]]) -> List[str]:
+    out: List[str] = []
+    for rec in corpus:
+        out += [m.group(1) for m in bot._EUR_PRICE_RE.finditer(rec["caption"])]
+        out += [m.group("price") for m in bot.PRICE_DISCOUNT_RE.finditer(rec["caption"])]
+    return out
+
+def _multi_uncached(caption: str):
+    # кэш разбора из bot.py иначе превратит замер в замер попаданий
+    bot._parse_cache.clear()
+    return bot.build_result_text_multi(BENCH_USER, caption)
+
+def cases(corpus: List[Dict[str, str]]) -> Dict[str, Tuple[Callable[[Any], Any], List[Any]]]:
+    captions = [rec["caption"] for rec in corpus]
+    return {
+        "parse_input": (bot.parse_input, captions),
+        "_split_positions": (bot._split_positions, captions),
+        "extract_sizes_anywhere": (bot.extract_sizes_anywhere, captions),
+        "parse_money_token": (bot.parse_money_token, money_tokens(corpus)),
+        "build_result_text_multi": (_multi_uncached, captions),
+    }
+
+# ---------- эталон ----------
+def golden_outputs(corpus: List[Dict[str, str]]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for rec in corpus:
+        cap = rec["caption"]
+        row: Dict[str, Any] = {
+            "parse_input": bot.parse_input(cap),
+            "split_positions": bot._split_positions(cap),
+            "sizes_anywhere": bot.extract_sizes_anywhere(cap),
+        }
+        for mode in GOLDEN_MODES:
+            bot.active_mode[BENCH_USER] = mode
+            bot._card_cache.clear()
+            row[f"card_{mode}"] = bot.build_result_text(BENCH_USER, cap)
+        bot.active_mode.pop(BENCH_USER, None)
+        out[rec["id"]] = row
+    return out
+
+def check_golden(corpus: List[Dict[str, str]]) -> List[str]:
+    with open(GOLDEN_PATH, encoding="utf-8") as f:
+        expected = json.load(f)
+    actual = json.loads(json.dumps(golden_outputs(corpus), ensure_ascii=False))  # кортежи → списки, как в файле
+    diffs: List[str] = []
+    for cid in sorted(set(expected) | set(actual)):
+        exp, act = expected.get(cid), actual.get(cid)
+        if exp is None or act is None:
+            diffs.append(f"{cid}: {'нет в эталоне' if exp is None else 'нет в корпусе'}")
+            continue
+        for field in sorted(set(exp) | set(act)):
+            if exp.get(field) != act.get(field):
+                diffs.append(f"{cid}.{field}:\n  было: {exp.get(field)!r}\n  стало: {act.get(field)!r}")
+    return diffs
+
+# ---------- замер ----------
+def _percentile(sorted_ns: List[int], q: float) -> float:
+    idx = min(len(sorted_ns) - 1, max(0, int(round(q * (len(sorted_ns) - 1)))))
+    return sorted_ns[idx] / 1000.0
+
+def run_case(fn: Callable[[Any], Any], inputs: List[Any], rounds: int) -> Dict[str, float]:
+    for x in inputs:  # прогрев
+        fn(x)
+    samples: List[int] = []
+    perf = time.perf_counter_ns
+    for _ in range(rounds):
+        for x in inputs:
+            t0 = perf()
+            fn(x)
+            samples.append(perf() - t0)
+    samples.sort()
+    total_s = sum(samples) / 1e9
+    return {
+        "calls": len(samples),
+        "ops_per_s": len(samples) / total_s if total_s else float("inf"),
+        "p50_us": _percentile(samples, 0.50),
+        "p95_us": _percentile(samples, 0.95),
+        "p99_us": _percentile(samples, 0.99),
+        "max_us": samples[-1] / 1000.0,
+    }
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Бенчмарк парсера и расчёта цен")
+    ap.add_argument("--rounds", type=int, default=20, help="прогонов корпуса на функцию")
+    ap.add_argument("--only", action="append", help="замерить только эту функцию (можно несколько раз)")
+    ap.add_argument("--update-golden", action="store_true", help="перезаписать bench_golden.json")
+    ap.add_argument("--skip-golden", action="store_true", help="не сверять с эталоном")
+    args = ap.parse_args(argv)
+
+    corpus = load_corpus()
+    if args.update_golden:
+        with open(GOLDEN_PATH, "w", encoding="utf-8") as f:
+            json.dump(golden_outputs(corpus), f, ensure_ascii=False, indent=1, sort_keys=True)
+        print(f"Эталон обновлён: {GOLDEN_PATH} ({len(corpus)} подписей)")
+        return 0
+
+    if not args.skip_golden:
+        diffs = check_golden(corpus)
+        if diffs:
+            print(f"ЭТАЛОН НЕ СОВПАЛ ({len(diffs)}):")
+            print("\n".join(diffs))
+            return 1
+        print(f"Эталон совпал: {len(corpus)} подписей, режимы {', '.join(GOLDEN_MODES)}")
+
+    lines = max(rec["caption"].count("\n") + 1 for rec in corpus)
+    print(f"Корпус: {len(corpus)} подписей (до {lines} строк), прогонов: {args.rounds}\n")
+    print(f"{'функция':<26}{'вызовов':>9}{'оп/с':>12}{'p50 мкс':>10}{'p95 мкс':>10}{'p99 мкс':>10}{'max мкс':>10}")
+    for name, (fn, inputs) in cases(corpus).items():
+        if args.only and name not in args.only:
+            continue
+        r = run_case(fn, inputs, args.rounds)
+        print(f"{name:<26}{r['calls']:>9}{r['ops_per_s']:>12.0f}{r['p50_us']:>10.1f}"
+              f"{r['p95_us']:>10.1f}{r['p99_us']:>10.1f}{r['max_us']:>10.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
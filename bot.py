@@ -11,26 +11,61 @@ import re
 import io
 import math
 import json
+import hashlib
+import sqlite3
+import threading
+import uuid
+import secrets
+import html
+import pstats
+import cProfile
 import asyncio
 import heapq
-from typing import Dict, Callable, Optional, List, Tuple, Any
+import bisect
+import sys
+import csv
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Callable, Optional, List, Tuple, Any, Awaitable, Sequence, Iterator
 from datetime import datetime, timedelta
-from dataclasses import dataclass, field
-from collections import deque
+from dataclasses import dataclass, field, fields
+from enum import Enum
+from operator import attrgetter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
 
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.types import Message, InputMediaPhoto, InputMediaVideo
+from aiogram.types import Message, Update, InputMediaPhoto, InputMediaVideo, BufferedInputFile
 from aiogram.enums import ParseMode, MessageEntityType
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web, ClientConnectorError
 
 # ====== НАСТРОЙКИ ======
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "-1002973176038"))
 ADMINS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+# Маршрутизация в несколько витрин, JSON: {"default": [id, ...], "mode:lux": [...], "chat:<исходный чат>": [...]}
+# приоритет: chat → mode → default; без настройки — только TARGET_CHAT_ID
+TARGET_ROUTES = os.getenv("TARGET_ROUTES", "").strip()
 
 ALBUM_SETTLE_MS = int(os.getenv("ALBUM_SETTLE_MS", "1500"))  # стабильнее собирает альбомы
 ALBUM_WINDOW_SECONDS = int(os.getenv("ALBUM_WINDOW_SECONDS", "30"))
+# Адаптивная сборка: пауза после последнего кадра = p(ALBUM_SETTLE_QUANTILE) интервалов между кадрами
+# альбомов этого чата × ALBUM_SETTLE_FACTOR, в пределах [ALBUM_SETTLE_MIN_MS, ALBUM_SETTLE_MS]
+ALBUM_SETTLE_ADAPTIVE = os.getenv("ALBUM_SETTLE_ADAPTIVE", "1") == "1"
+ALBUM_SETTLE_MIN_MS = int(os.getenv("ALBUM_SETTLE_MIN_MS", "250"))
+ALBUM_SETTLE_QUANTILE = float(os.getenv("ALBUM_SETTLE_QUANTILE", "0.95"))
+ALBUM_SETTLE_FACTOR = float(os.getenv("ALBUM_SETTLE_FACTOR", "2.0"))
+ALBUM_SETTLE_MIN_SAMPLES = int(os.getenv("ALBUM_SETTLE_MIN_SAMPLES", "20"))  # до этого — фиксированный ALBUM_SETTLE_MS
+ALBUM_MAX_ITEMS = 10  # больше кадров Telegram в один альбом не кладёт
 
 # Сколько держать текст с эмодзи в ожидании фото (очереди партий)
 BATCH_IDLE_MS = int(os.getenv("BATCH_IDLE_MS", "2800"))
@@ -40,6 +75,80 @@ OCR_ENABLED = os.getenv("OCR_ENABLED", "1") == "1"
 OCR_LANG = os.getenv("OCR_LANG", "ita+eng")
 VISION_JSON = os.getenv("VISION_JSON", "").strip()  # если есть — используем Google Vision
 
+# OCR вне event loop: Tesseract — в пуле процессов, Vision — в пуле потоков
+OCR_PROCESS_WORKERS = int(os.getenv("OCR_PROCESS_WORKERS", str(os.cpu_count() or 1)))  # 0 — Tesseract в потоках
+OCR_THREAD_WORKERS = int(os.getenv("OCR_THREAD_WORKERS", "4"))
+OCR_QUEUE_MAX = int(os.getenv("OCR_QUEUE_MAX", "32"))          # сколько OCR-задач одновременно в работе/очереди пулов
+OCR_JOB_TIMEOUT_S = float(os.getenv("OCR_JOB_TIMEOUT_S", "20"))
+OCR_ALBUM_CONCURRENCY = int(os.getenv("OCR_ALBUM_CONCURRENCY", "4"))  # параллельных скачиваний+OCR на один альбом
+OCR_MIN_PIXELS = int(os.getenv("OCR_MIN_PIXELS", "500000"))  # для OCR качаем наименьший PhotoSize не меньше этого
+
+# Кэш вердиктов OCR по file_unique_id (переживает перезапуск)
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "ocr_cache.sqlite3")  # пусто — только память
+OCR_CACHE_MEM_MAX = int(os.getenv("OCR_CACHE_MEM_MAX", "5000"))
+OCR_CACHE_TTL_H = float(os.getenv("OCR_CACHE_TTL_H", str(24 * 30)))
+
+# Кэш разбора подписей и готовых карточек
+PARSE_CACHE_MAX = int(os.getenv("PARSE_CACHE_MAX", "2000"))
+CARD_CACHE_MAX = int(os.getenv("CARD_CACHE_MAX", "2000"))
+
+# Быстрый предфильтр кадров до OCR (по уменьшенной копии, единицы миллисекунд)
+PRECHECK_ENABLED = os.getenv("PRECHECK_ENABLED", "1") == "1"
+PRECHECK_SIZE = int(os.getenv("PRECHECK_SIZE", "192"))                    # сторона уменьшенной копии, px
+PRECHECK_MIN_EDGE = float(os.getenv("PRECHECK_MIN_EDGE", "0.01"))         # доля «контурных» пикселей
+PRECHECK_MIN_TEXT_ROWS = float(os.getenv("PRECHECK_MIN_TEXT_ROWS", "0.04"))  # доля строк, похожих на текст
+PRICETAG_HASHES_PATH = os.getenv("PRICETAG_HASHES_PATH", "pricetag_hashes.txt")  # dHash известных ценников
+PRICETAG_HASHES_MAX = int(os.getenv("PRICETAG_HASHES_MAX", "500"))
+PRICETAG_HASH_MAX_DIST = int(os.getenv("PRICETAG_HASH_MAX_DIST", "6"))
+
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота, ~20 сообщений/мин в группу/канал
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))              # сообщений в секунду на бота
+TG_CHAT_RATE_PER_MIN = float(os.getenv("TG_CHAT_RATE_PER_MIN", "20"))  # сообщений в минуту в один чат
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))                 # сколько можно отправить в чат подряд
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "8"))                 # повторов на RetryAfter/сбой соединения
+
+# Окно переупорядочивания публикаций: пост ждёт, пока в том же чате не останется
+# незавершённых (буфер альбома / медиа в ожидании текста / партия) с меньшим message_id
+REORDER_MAX_HOLD_MS = int(os.getenv("REORDER_MAX_HOLD_MS", str(ALBUM_SETTLE_MS + 1500)))
+REORDER_TICK_MS = int(os.getenv("REORDER_TICK_MS", "50"))
+LANE_IDLE_S = float(os.getenv("LANE_IDLE_S", "300"))              # простаивающая полоса закрывается
+
+# Долговременное состояние (SQLite, WAL): режимы, буферы альбомов, медиа в ожидании текста,
+# партии и неотправленные публикации переживают рестарт/деплой — только если файл лежит на постоянном
+# диске (на Render — смонтированный Disk, напр. /var/data/bot_state.sqlite3): локальная ФС стирается каждым деплоем
+STATE_PATH = os.getenv("STATE_PATH", "bot_state.sqlite3")  # пусто — всё только в памяти, как раньше
+STATE_FLUSH_MS = int(os.getenv("STATE_FLUSH_MS", "200"))    # изменения коммитятся пачкой с таким периодом
+
+# Приём апдейтов: задан WEBHOOK_URL — вебхук (встроенный aiohttp-сервер), иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()          # публичный адрес, напр. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()    # сверяется с X-Telegram-Bot-Api-Secret-Token; пусто — случайный на запуск
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))                 # Render передаёт порт в PORT
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "64"))  # апдейтов в обработке одновременно
+
+# Метрики: Prometheus-текст на /metrics (в режиме вебхука — на том же сервере)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # в режиме polling: >0 — поднять отдельный сервер метрик
+TRACE_LOG = os.getenv("TRACE_LOG", "1") == "1"      # JSON-строки со временем этапов по trace id апдейта
+PROFILE_MAX_S = int(os.getenv("PROFILE_MAX_S", "120"))  # потолок для /profile
+
+# Пределы хранилищ в памяти (0 — без предела): TTL считается от последней записи,
+# по max-entries вытесняется самая давняя запись, объём (оценка) проверяется при обходе
+LAST_MEDIA_TTL_S = float(os.getenv("LAST_MEDIA_TTL_S", "600"))   # медиа без текста дольше — публикуем как есть
+LAST_MEDIA_MAX = int(os.getenv("LAST_MEDIA_MAX", "2000"))
+ALBUM_BUFFER_TTL_S = float(os.getenv("ALBUM_BUFFER_TTL_S", "120"))  # «осиротевший» буфер альбома — публикуем
+ALBUM_BUFFERS_MAX = int(os.getenv("ALBUM_BUFFERS_MAX", "2000"))
+BATCHES_TTL_S = float(os.getenv("BATCHES_TTL_S", "600"))         # очередь партий чата без движения — сбрасываем
+BATCHES_MAX = int(os.getenv("BATCHES_MAX", "2000"))
+STORE_MAX_MB = float(os.getenv("STORE_MAX_MB", "32"))            # на одно хранилище
+STORE_SWEEP_S = float(os.getenv("STORE_SWEEP_S", "30"))
+
+# Импорт прайсов документом (/import в подписи к CSV/XLSX/TXT)
+IMPORT_MAX_MB = float(os.getenv("IMPORT_MAX_MB", "20"))        # Bot API отдаёт ботам файлы до 20 МБ
+IMPORT_PUBLISH_BATCH = int(os.getenv("IMPORT_PUBLISH_BATCH", "10"))  # карточек в одном сообщении при публикации
+IMPORT_PUBLISH_MAX = int(os.getenv("IMPORT_PUBLISH_MAX", "300"))     # больше карточек в канал не ставим: очередь на часы
+
 # Базовая политика: в альбомах убирать кадры-ценники (1 — да; 0 — пересылать как есть)
 FILTER_PRICETAGS_IN_ALBUMS = os.getenv("FILTER_PRICETAGS_IN_ALBUMS", "1") == "1"
 
@@ -50,20 +159,548 @@ router = Router()
 dp.include_router(router)
 
 # ====== ПАМЯТЬ ======
-# MediaItem: {"kind": "photo"|"video"|"text"|"forward", "fid": str, "mid": int, "cap": bool}
-last_media: Dict[int, Dict[str, Any]] = {}
+def approx_size(obj: Any, _seen: Optional[set] = None) -> int:
+    """Грубая оценка занимаемой памяти (байт) с обходом контейнеров; общие объекты считаются один раз."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, _seen) + approx_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(approx_size(x, _seen) for x in obj)
+    elif isinstance(obj, (asyncio.Task, asyncio.Semaphore, type)):
+        pass
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), _seen)  # dataclass / pydantic-модель (Message)
+    elif hasattr(obj, "__slots__"):
+        size += sum(approx_size(getattr(obj, f.name), _seen) for f in fields(obj))  # MediaItem / Payload
+    return size
+
+class BoundedStore(MutableMapping):
+    """dict с пределами: TTL от последней записи (или touch), max_entries — вытесняется самая давняя,
+    max_bytes — оценка объёма, проверяется в sweep(). on_evict(key, value, reason) вызывается после
+    удаления записи: там её либо публикуют как есть, либо просто отпускают."""
+    def __init__(self, name: str, ttl_s: float = 0.0, max_entries: int = 0, max_bytes: int = 0,
+                 on_evict: Optional[Callable[[Any, Any, str], None]] = None):
+        self.name = name
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()  # по времени последней записи
+        self.approx_bytes = 0
+        self.evicted: Dict[str, int] = {"ttl": 0, "max_entries": 0, "max_bytes": 0}
+
+    def __getitem__(self, key):
+        return self._data[key][1]
+
+    def get(self, key, default=None):
+        rec = self._data.get(key)
+        return default if rec is None else rec[1]
+
+    def __setitem__(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while self.max_entries and len(self._data) > self.max_entries:
+            self._evict(next(iter(self._data)), "max_entries")
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"BoundedStore({self.name!r}, {dict(self.items())!r})"
+
+    def touch(self, key):
+        """Значение изменили на месте (добавили кадр/партию) — продлеваем TTL."""
+        rec = self._data.get(key)
+        if rec is not None:
+            self._data[key] = (time.monotonic(), rec[1])
+            self._data.move_to_end(key)
+
+    def _evict(self, key, reason: str):
+        _, value = self._data.pop(key)
+        self.evicted[reason] += 1
+        if self.on_evict:
+            try:
+                self.on_evict(key, value, reason)
+            except Exception as e:
+                print(f"STORE {self.name} evict failed:", repr(e))
+
+    def sweep(self):
+        if self.ttl_s:
+            deadline = time.monotonic() - self.ttl_s
+            while self._data:
+                key, (ts, _) = next(iter(self._data.items()))
+                if ts > deadline:
+                    break
+                self._evict(key, "ttl")
+        sizes = [(key, approx_size(rec[1])) for key, rec in self._data.items()]
+        self.approx_bytes = sum(sz for _, sz in sizes)
+        for key, sz in sizes:  # от самых давних
+            if not self.max_bytes or self.approx_bytes <= self.max_bytes:
+                break
+            if key in self._data:
+                self._evict(key, "max_bytes")
+                self.approx_bytes -= sz
+
+    def stats_line(self) -> str:
+        ev = ", ".join(f"{k} {v}" for k, v in self.evicted.items() if v) or "нет"
+        return f"{self.name}: {len(self._data)} записей, ~{self.approx_bytes / 1024:.0f} KB, вытеснено: {ev}"
+
+_STORE_MAX_BYTES = int(STORE_MAX_MB * 1024 * 1024)
+
+class MediaKind(str, Enum):
+    PHOTO = "photo"
+    VIDEO = "video"
+    TEXT = "text"
+    FORWARD = "forward"
+
+@dataclass(slots=True, eq=False)
+class MediaItem:
+    """Единица публикации. uid — file_unique_id: одинаков у репостов одного и того же файла,
+    в отличие от fid. sizes у фото — (file_id, width, height) по возрастанию площади, для OCR;
+    публикуется всегда fid (наибольший размер). ocr — задача OCR, запущенная заранее при приёме
+    кадра альбома (см. _start_speculative_ocr)."""
+    kind: MediaKind
+    mid: int
+    fid: str = ""
+    uid: str = ""
+    cap: bool = False
+    sizes: Optional[Tuple[Tuple[str, int, int], ...]] = None
+    from_chat_id: int = 0  # для FORWARD
+    ocr: Optional[asyncio.Task] = None
+
+    def to_state(self) -> Dict[str, Any]:
+        # задача OCR не сериализуется — после рестарта OCR просто посчитается заново
+        d: Dict[str, Any] = {"kind": self.kind.value, "mid": self.mid, "fid": self.fid, "cap": self.cap}
+        if self.uid:
+            d["uid"] = self.uid
+        if self.sizes:
+            d["sizes"] = self.sizes
+        if self.from_chat_id:
+            d["from_chat_id"] = self.from_chat_id
+        return d
+
+    @classmethod
+    def from_state(cls, d: Dict[str, Any]) -> "MediaItem":
+        sizes = d.get("sizes")
+        return cls(kind=MediaKind(d["kind"]), mid=d["mid"], fid=d.get("fid", ""), uid=d.get("uid", ""),
+                   cap=d.get("cap", False), sizes=tuple(tuple(s) for s in sizes) if sizes else None,
+                   from_chat_id=d.get("from_chat_id", 0))
+
+mid_of = attrgetter("mid")
+
+# обработчики вытеснения (on_evict) назначаются ниже, рядом с кодом, который умеет публиковать
+last_media: BoundedStore = BoundedStore("last_media", LAST_MEDIA_TTL_S, LAST_MEDIA_MAX, _STORE_MAX_BYTES)
+album_buffers: BoundedStore = BoundedStore("album_buffers", ALBUM_BUFFER_TTL_S, ALBUM_BUFFERS_MAX, _STORE_MAX_BYTES)
+# режимы не вытесняем: это настройка цен админов (их единицы), а не кэш — потеря молча меняла бы цены
 active_mode: Dict[int, str] = {}
-album_buffers: Dict[Tuple[int, str], Dict[str, Any]] = {}
+# открытые альбомы по чатам: [(последний mid, media_group_id)] по возрастанию mid — чтобы
+# handle_text и pending_floor не перебирали буферы всех чатов
+album_index: Dict[int, List[Tuple[int, str]]] = {}
+
+def album_index_update(key: Tuple[int, str], buf: Dict[str, Any]):
+    """Вызывать после добавления кадра в буфер: переставляет альбом по его последнему mid."""
+    chat_id, mgid = key
+    prev = buf.get("last_mid")
+    last_mid = buf["items"][-1].mid  # items упорядочены по mid (bisect.insort при приёме)
+    if last_mid == prev:
+        return
+    lst = album_index.setdefault(chat_id, [])
+    if prev is not None:
+        del lst[bisect.bisect_left(lst, (prev, mgid))]
+    buf["last_mid"] = last_mid
+    bisect.insort(lst, (last_mid, mgid))
+
+def album_index_remove(key: Tuple[int, str], buf: Optional[Dict[str, Any]]):
+    chat_id, mgid = key
+    lst = album_index.get(chat_id)
+    if not lst or not buf or "last_mid" not in buf:
+        return
+    i = bisect.bisect_left(lst, (buf["last_mid"], mgid))
+    if i < len(lst) and lst[i] == (buf["last_mid"], mgid):
+        del lst[i]
+    if not lst:
+        del album_index[chat_id]
+
+def album_for_text(chat_id: int, text_mid: int) -> Optional[Tuple[int, str]]:
+    """Альбом, к которому относится текст: последний закончившийся не позже текста, иначе самый свежий."""
+    lst = album_index.get(chat_id)
+    if not lst:
+        return None
+    i = bisect.bisect_right(lst, text_mid, key=lambda e: e[0])
+    return (chat_id, lst[i - 1 if i else -1][1])
+
+# ====== МЕТРИКИ ======
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, n: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0.0) + n
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+class Histogram:
+    """Гистограмма с фиксированными границами (секунды), по набору меток — своя серия."""
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.buckets = name, help_text, buckets
+        self.series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}  # [n по корзинам..., +Inf, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        row = self.series.get(key)
+        if row is None:
+            row = self.series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                row[i] += 1
+                break
+        else:
+            row[len(self.buckets)] += 1
+        row[-1] += value
+
+    def quantile(self, row: List[float], q: float) -> float:
+        # верхняя граница корзины, куда попал квантиль — для /stats достаточно
+        count = sum(row[:-1])
+        acc = 0.0
+        for i, b in enumerate(self.buckets):
+            acc += row[i]
+            if acc >= q * count:
+                return b
+        return float("inf")
+
+_metrics_counters: Dict[str, Counter] = {}
+_metrics_histograms: Dict[str, Histogram] = {}
+_metrics_gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+def counter(name: str, help_text: str) -> Counter:
+    return _metrics_counters.setdefault(name, Counter(name, help_text))
+
+def histogram(name: str, help_text: str) -> Histogram:
+    return _metrics_histograms.setdefault(name, Histogram(name, help_text))
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]):
+    # значение считается в момент чтения — ничего не нужно обновлять на горячем пути
+    _metrics_gauges[name] = (help_text, fn)
+
+def _labels_text(key: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def metrics_text() -> str:
+    out: List[str] = []
+    for c in _metrics_counters.values():
+        out += [f"# HELP {c.name} {c.help}", f"# TYPE {c.name} counter"]
+        out += [f"{c.name}{_labels_text(k)} {v:g}" for k, v in c.values.items()] or [f"{c.name} 0"]
+    for name, (help_text, fn) in _metrics_gauges.items():
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"METRICS gauge {name} failed:", repr(e))
+            continue
+        out += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+    for h in _metrics_histograms.values():
+        out += [f"# HELP {h.name} {h.help}", f"# TYPE {h.name} histogram"]
+        for key, row in h.series.items():
+            acc = 0.0
+            for i, b in enumerate(h.buckets):
+                acc += row[i]
+                le = 'le="%g"' % b
+                out.append(f"{h.name}_bucket{_labels_text(key, le)} {acc:g}")
+            acc += row[len(h.buckets)]
+            inf_label = _labels_text(key, 'le="+Inf"')
+            out.append(f"{h.name}_bucket{inf_label} {acc:g}")
+            out.append(f"{h.name}_sum{_labels_text(key)} {row[-1]:.6f}")
+            out.append(f"{h.name}_count{_labels_text(key)} {acc:g}")
+    return "\n".join(out) + "\n"
+
+def metrics_stats_line() -> str:
+    rows: List[str] = []
+    for h in _metrics_histograms.values():
+        for key, row in sorted(h.series.items()):
+            n = sum(row[:-1])
+            if not n:
+                continue
+            label = ",".join(v for _, v in key)
+            rows.append(f"• {h.name}{'[' + label + ']' if label else ''}: {n:.0f} шт, ср. {row[-1] / n * 1000:.1f} ms, "
+                        f"p95 ≤ {h.quantile(row, 0.95) * 1000:g} ms")
+    for name, (_, fn) in _metrics_gauges.items():
+        try:
+            rows.append(f"• {name}: {fn():g}")
+        except Exception:
+            pass
+    for c in _metrics_counters.values():
+        rows.append(f"• {c.name}: {c.total():g}")
+    return "Метрики:\n" + "\n".join(rows)
+
+M_ALBUM_SETTLE = histogram("album_settle_wait_seconds", "От первого кадра альбома до его сборки")
+M_PARSE = histogram("parse_seconds", "Разбор подписи и сборка карточки (с учётом кэша)")
+M_OCR_DOWNLOAD = histogram("ocr_download_seconds", "Скачивание кадра для OCR")
+M_OCR = histogram("ocr_seconds", "Распознавание кадра, по движкам")
+M_LANE_WAIT = histogram("publish_lane_wait_seconds", "Ожидание в полосе публикации (порядок по message_id)")
+M_OUTBOX_WAIT = histogram("outbox_wait_seconds", "Ожидание в очереди витрины до отправки")
+M_TG_CALL = histogram("telegram_call_seconds", "Вызов Telegram Bot API, по методам")
+M_OCR_HIDDEN = counter("ocr_hidden_total", "Кадры-ценники, скрытые из альбомов")
+M_PARSE_FAIL = counter("parse_failures_total", "Публикации с подсказкой «Не нашла цену»")
+M_PUBLISH_ERRORS = counter("publish_errors_total", "Неудачные отправки в витрины")
+
+gauge("album_buffers", "Открытые буферы альбомов", lambda: len(album_buffers))
+gauge("last_media", "Медиа в ожидании текста", lambda: len(last_media))
+gauge("active_mode", "Пользователи с выбранным режимом", lambda: len(active_mode))
+
+# ====== ТРАССИРОВКА ======
+# trace id выдаётся апдейту на входе и едет дальше: буфер альбома → payload полосы → job витрины.
+# В пределах одной задачи asyncio он лежит в ContextVar (create_task копирует контекст).
+_trace_id: ContextVar[str] = ContextVar("trace_id", default="")
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+def trace_event(span: str, **fields):
+    if not TRACE_LOG:
+        return
+    rec = {"ts": round(time.time(), 3), "trace": _trace_id.get(), "span": span}
+    rec.update(fields)
+    print(json.dumps(rec, ensure_ascii=False, default=str))
+
+@contextmanager
+def trace_span(span: str, **fields):
+    t0 = time.perf_counter()
+    try:
+        yield fields  # этап может дописать свои поля по ходу
+    finally:
+        trace_event(span, ms=round((time.perf_counter() - t0) * 1000, 2), **fields)
+
+# ====== ТАЙМЕРЫ ======
+class TimerWheel:
+    """Все отложенные действия (сборка альбома, срок партии) — в одной куче дедлайнов,
+    которую разбирает одна задача. Перевзвод — запись в словарь и push в кучу, без
+    создания/отмены задач; устаревшие записи кучи пропускаются при извлечении."""
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Any]] = []  # (deadline, gen, key)
+        self._live: Dict[Any, Tuple[float, int, Callable[[], Awaitable[Any]]]] = {}
+        self._gen = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.fired = 0
+        self.rescheduled = 0
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def schedule(self, key: Any, delay_s: float, callback: Callable[[], Awaitable[Any]]):
+        """Взвести (или перевзвести) таймер key: через delay_s запустится callback()."""
+        if key in self._live:
+            self.rescheduled += 1
+        self._gen += 1
+        deadline = time.monotonic() + max(0.0, delay_s)
+        self._live[key] = (deadline, self._gen, callback)
+        heapq.heappush(self._heap, (deadline, self._gen, key))
+        self._maybe_compact()
+        if self._heap[0][1] == self._gen:  # новый ближайший дедлайн — будим цикл
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key: Any) -> bool:
+        return self._live.pop(key, None) is not None
+
+    def deadline(self, key: Any) -> Optional[float]:
+        rec = self._live.get(key)
+        return rec[0] if rec else None
+
+    def _maybe_compact(self):
+        if len(self._heap) > 2 * len(self._live) + 64:
+            # частые перевзводы копят мёртвые записи — пересобираем кучу
+            self._heap = [e for e in self._heap if self._live.get(e[2], (0, None))[1] == e[1]]
+            heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _, gen, key = heapq.heappop(self._heap)
+                rec = self._live.get(key)
+                if rec is None or rec[1] != gen:
+                    continue  # отменён или перевзведён
+                del self._live[key]
+                self.fired += 1
+                asyncio.create_task(self._fire(key, rec[2]))
+            self._maybe_compact()
+            self._wakeup.clear()
+            try:
+                async with asyncio.timeout(self._heap[0][0] - now if self._heap else None):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    @staticmethod
+    async def _fire(key: Any, callback: Callable[[], Awaitable[Any]]):
+        try:
+            await callback()
+        except Exception as e:
+            print(f"TIMER ERROR {key!r}:", repr(e))
+
+    def stats_line(self) -> str:
+        return (f"Таймеры: активных {len(self._live)}, в куче {len(self._heap)}, "
+                f"сработало {self.fired}, перевзведено {self.rescheduled}")
+
+timers = TimerWheel()
+gauge("timers_live", "Взведённые таймеры (альбомы, партии)", lambda: len(timers))
+
+# ====== ДОЛГОВРЕМЕННОЕ СОСТОЯНИЕ ======
+def _ephemeral_path_warning(path: str) -> str:
+    """Пустая строка, если файл на отдельно смонтированном диске; иначе — почему это, скорее всего, не так."""
+    if not os.path.isabs(path):
+        return "относительный путь (в рабочей папке контейнера)"
+    d = os.path.dirname(path) or "/"
+    while not os.path.ismount(d):
+        d = os.path.dirname(d)
+    return "не на смонтированном диске (корневая ФС контейнера)" if d == "/" else ""
+
+class StateStore:
+    """Пространства имён «ключ → JSON» в одной таблице SQLite (WAL). Изменения копятся
+    в памяти (по ключу побеждает последнее) и коммитятся одной транзакцией раз в STATE_FLUSH_MS."""
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._staged: Dict[Tuple[str, str], Optional[str]] = {}
+        self._lock = threading.Lock()
+        self.commits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    def open(self):
+        if not self.path:
+            return
+        warning = _ephemeral_path_warning(self.path)
+        if warning:
+            print(f"STATE WARNING: {self.path}: {warning} — режимы, альбомы и неотправленные публикации "
+                  f"пропадут при деплое. Укажи STATE_PATH на смонтированном постоянном диске.")
+        try:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (ns TEXT, key TEXT, value TEXT, PRIMARY KEY (ns, key))")
+            conn.commit()
+            self._conn = conn
+        except Exception as e:
+            print("STATE DB init failed:", repr(e))
+
+    def put(self, ns: str, key: Any, value: Any):
+        if self._conn is not None:
+            self._staged[(ns, str(key))] = json.dumps(value, ensure_ascii=False)
+
+    def delete(self, ns: str, key: Any):
+        if self._conn is not None:
+            self._staged[(ns, str(key))] = None
+
+    def load(self, ns: str) -> Dict[str, Any]:
+        if self._conn is None:
+            return {}
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM state WHERE ns = ?", (ns,)).fetchall()
+        out: Dict[str, Any] = {}
+        for key, value in rows:
+            try:
+                out[key] = json.loads(value)
+            except ValueError as e:
+                print(f"STATE bad row {ns}/{key}:", repr(e))
+        return out
+
+    def _write(self, ops: List[Tuple[Tuple[str, str], Optional[str]]]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO state (ns, key, value) VALUES (?, ?, ?)",
+                [(ns, key, value) for (ns, key), value in ops if value is not None],
+            )
+            self._conn.executemany(
+                "DELETE FROM state WHERE ns = ? AND key = ?",
+                [(ns, key) for (ns, key), value in ops if value is None],
+            )
+        self.commits += 1
+
+    async def flush(self):
+        if self._conn is None or not self._staged:
+            return
+        ops, self._staged = list(self._staged.items()), {}
+        try:
+            await asyncio.to_thread(self._write, ops)
+        except Exception as e:
+            print("STATE flush failed:", repr(e))
+            for k, v in ops:  # повторим в следующий раз; более свежие изменения важнее
+                self._staged.setdefault(k, v)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_MS / 1000)
+            await self.flush()
+
+state = StateStore(STATE_PATH)
+
+def _items_to_state(items: Sequence[MediaItem]) -> List[Dict[str, Any]]:
+    return [it.to_state() for it in items]
+
+def _items_from_state(rows: List[Dict[str, Any]]) -> List[MediaItem]:
+    return [MediaItem.from_state(d) for d in rows]
+
+def persist_album(key: Tuple[int, str]):
+    buf = album_buffers.get(key)
+    skey = f"{key[0]}|{key[1]}"
+    if buf is None:
+        state.delete("album", skey)
+        return
+    state.put("album", skey, {"items": _items_to_state(buf["items"]), "caption": buf["caption"],
+                              "user_id": buf["user_id"], "first_mid": buf["first_mid"], "trace": buf.get("trace", "")})
+
+def persist_last_media(chat_id: int):
+    bucket = last_media.get(chat_id)
+    if bucket is None:
+        state.delete("last_media", chat_id)
+        return
+    state.put("last_media", chat_id, {"ts": bucket["ts"].isoformat(), "items": _items_to_state(bucket["items"]),
+                                      "caption": bucket["caption"], "user_id": bucket["user_id"],
+                                      "first_mid": bucket["first_mid"]})
+
+def persist_batches(chat_id: int):
+    q = batches.get(chat_id)
+    if not q:
+        state.delete("batch", chat_id)
+        return
+    state.put("batch", chat_id, [
+        {"text_msg": rec.text_msg.model_dump(mode="json", exclude_none=True) if rec.text_msg else None,
+         "media": _items_to_state(rec.media), "user_id": rec.user_id}
+        for rec in q
+    ])
 
 # -------- Очередь партий (FIFO) для текстов-эмодзи и их медиа --------
 @dataclass
 class BatchRec:
     text_msg: Optional[Message] = None
-    media: List[Dict[str, Any]] = field(default_factory=list)
-    timer: Optional[asyncio.Task] = None
+    media: List[MediaItem] = field(default_factory=list)
     user_id: Optional[int] = None
 
-batches: Dict[int, deque[BatchRec]] = {}
+batches: BoundedStore = BoundedStore("batches", BATCHES_TTL_S, BATCHES_MAX, _STORE_MAX_BYTES)  # chat_id → deque[BatchRec]
+gauge("batches", "Тексты-эмодзи в ожидании медиа", lambda: sum(len(q) for q in batches.values()))
 
 def _get_q(chat_id: int) -> deque:
     q = batches.get(chat_id)
@@ -71,43 +708,68 @@ def _get_q(chat_id: int) -> deque:
         q = batches[chat_id] = deque()
     return q
 
+def _remove_from_q(chat_id: int, rec: BatchRec):
+    q = _get_q(chat_id)
+    q.remove(rec)
+    if not q:
+        batches.pop(chat_id, None)  # пустые очереди не копим
+    persist_batches(chat_id)
+
+def _evict_batches(chat_id: int, q: deque, reason: str):
+    # тексты без медиа и так не публикуются по таймауту — просто отпускаем
+    for rec in q:
+        timers.cancel(_batch_timer_key(rec))
+    persist_batches(chat_id)
+    print(f"STORE batches: chat {chat_id} dropped ({reason}), {len(q)} texts")
+
+batches.on_evict = _evict_batches
+_STORES = (last_media, album_buffers, batches)
+for _st in _STORES:
+    gauge(f"store_{_st.name}_bytes", f"Оценка памяти хранилища {_st.name}", lambda st=_st: st.approx_bytes)
+
+def stores_stats_line() -> str:
+    return "Память:\n" + "\n".join(f"• {st.stats_line()}" for st in _STORES)
+
+async def stores_sweeper():
+    while True:
+        await asyncio.sleep(STORE_SWEEP_S)
+        for st in _STORES:
+            st.sweep()
+
+def _batch_timer_key(rec: BatchRec) -> Tuple[str, int]:
+    return ("batch", id(rec))
+
 def _arm_batch_timer(chat_id: int, rec: BatchRec):
     # Если медиа не придут вовремя — ничего не публикуем (чтобы "ничего не улетало")
-    if rec.timer:
-        rec.timer.cancel()
     async def _fire():
-        try:
-            await asyncio.sleep(BATCH_IDLE_MS/1000)
-        except asyncio.CancelledError:
-            return
-        q = _get_q(chat_id)
-        if rec in q and not rec.media:
-            q.remove(rec)
-            return
-    rec.timer = asyncio.create_task(_fire())
+        q = batches.get(chat_id)
+        if q and rec in q and not rec.media:
+            _remove_from_q(chat_id, rec)
+    timers.schedule(_batch_timer_key(rec), BATCH_IDLE_MS / 1000, _fire)
 
 async def _publish_batch_pair(chat_id: int, rec: BatchRec):
     """Публикуем текст и медиа в ТОЧНОМ исходном порядке по message_id."""
-    if rec.timer:
-        rec.timer.cancel()
+    timers.cancel(_batch_timer_key(rec))
     if not rec.text_msg or not rec.media:
         return
 
     text_mid = rec.text_msg.message_id
-    first_media_mid = min(m["mid"] for m in rec.media)
+    first_media_mid = min(m.mid for m in rec.media)
     user_id = rec.user_id or (rec.text_msg.from_user.id if rec.text_msg.from_user else 0)
     seq_first = min(text_mid, first_media_mid)
 
     async def _send_text():
         await publish_to_target(
+            chat_id=chat_id,
             first_mid=seq_first,
             user_id=user_id,
-            items=[{"kind": "forward", "from_chat_id": rec.text_msg.chat.id, "mid": rec.text_msg.message_id, "cap": True}],
+            items=[MediaItem(MediaKind.FORWARD, rec.text_msg.message_id, cap=True, from_chat_id=rec.text_msg.chat.id)],
             caption=""
         )
 
     async def _send_media():
         await publish_to_target(
+            chat_id=chat_id,
             first_mid=seq_first,
             user_id=user_id,
             items=rec.media,
@@ -121,7 +783,7 @@ async def _publish_batch_pair(chat_id: int, rec: BatchRec):
         await _send_media()
         await _send_text()
 
-def _attach_media_to_next_batch(chat_id: int, media_items: List[Dict[str, Any]], user_id: int) -> bool:
+def _attach_media_to_next_batch(chat_id: int, media_items: List[MediaItem], user_id: int) -> bool:
     q = _get_q(chat_id)
     for rec in list(q):
         if rec.media:
@@ -129,15 +791,115 @@ def _attach_media_to_next_batch(chat_id: int, media_items: List[Dict[str, Any]],
         rec.media = media_items
         rec.user_id = rec.user_id or user_id
         asyncio.create_task(_publish_batch_pair(chat_id, rec))
-        q.remove(rec)
+        _remove_from_q(chat_id, rec)
         return True
     return False
 
-# ====== ГЛОБАЛЬНЫЙ ПОРЯДОК ПО message_id (min-heap) ======
-# payload: (seq, first_mid, user_id, items, caption, album_ocr_on)
-publish_queue: "asyncio.Queue[Tuple[int, int, int, List[Dict[str, Any]], str, bool]]" = asyncio.Queue()
-_heap: List[Tuple[int, int, Tuple[int, int, int, List[Dict[str, Any]], str, bool]]] = []
+# ====== ЛИМИТЫ TELEGRAM (token bucket) ======
+class TokenBucket:
+    """rate токенов/с, не больше capacity. Дорогой запрос (альбом = N сообщений) ждёт,
+    пока наберётся min(cost, capacity), и уводит баланс в минус — следующие подождут."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1.0):
+        need = min(cost, self.capacity)
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= need:
+                self.tokens -= cost
+                return
+            wait = max(self.blocked_until - now, (need - self.tokens) / self.rate)
+            await asyncio.sleep(max(wait, 0.01))
+
+    def block_for(self, seconds: float):
+        # Telegram сам сказал, сколько ждать (RetryAfter) — до этого момента в чат не шлём
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+_tg_global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_tg_chat_buckets: Dict[int, TokenBucket] = {}
+
+def _tg_chat_bucket(chat_id: int) -> TokenBucket:
+    b = _tg_chat_buckets.get(chat_id)
+    if b is None:
+        b = _tg_chat_buckets[chat_id] = TokenBucket(TG_CHAT_RATE_PER_MIN / 60.0, TG_CHAT_BURST)
+    return b
+
+async def tg_send(chat_id: int, cost: int, fn: Callable, /, *args, **kwargs):
+    """Вызов bot.send_*/forward_* с учётом лимитов: ждём токены, на RetryAfter ждём ровно
+    сколько сказано и повторяем; не удалось соединиться — повтор с backoff. Таймаут/обрыв/5xx могли
+    случиться уже после того, как Telegram принял сообщение, — такой повтор один и с пометкой о дубле."""
+    bucket = _tg_chat_bucket(chat_id)
+    attempt = 0
+    ambiguous = 0
+    while True:
+        await bucket.acquire(cost)
+        await _tg_global_bucket.acquire(cost)
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            attempt += 1
+            if attempt > TG_MAX_RETRIES:
+                raise
+            print(f"RETRY AFTER {e.retry_after}s: chat {chat_id}, {fn.__name__} (попытка {attempt})")
+            bucket.block_for(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            # aiogram поднимает TelegramNetworkError внутри except — исходная ошибка в __context__
+            not_sent = isinstance(e.__context__, ClientConnectorError)
+            attempt += 1
+            ambiguous += not not_sent
+            if attempt > TG_MAX_RETRIES or ambiguous > 1:
+                raise
+            delay = min(30.0, 0.5 * 2 ** attempt)
+            if not_sent:
+                print(f"TG RETRY in {delay:.1f}s: {fn.__name__}: {e!r}")
+            else:
+                print(f"TG RETRY in {delay:.1f}s (возможен дубль в chat {chat_id}): {fn.__name__}: {e!r}")
+            await asyncio.sleep(delay)
+        finally:
+            M_TG_CALL.observe(time.perf_counter() - t0, method=fn.__name__)
+
+# ====== ПОРЯДОК ПО message_id: полосы по исходным чатам (min-heap в каждой) ======
+@dataclass(frozen=True, slots=True)
+class Payload:
+    """Публикация в полосе: порядок по seq (первый message_id), элементы уже упорядочены по mid."""
+    seq: int
+    chat_id: int
+    first_mid: int
+    user_id: int
+    items: Tuple[MediaItem, ...]
+    caption: str
+    album_ocr_on: bool
+    enqueued_at: float
+    pid: str
+    trace: str = ""
+    targets: Tuple[int, ...] = ()   # витрины на момент расчёта карточки (режим мог смениться)
+
+@dataclass
+class PublishLane:
+    """Очередь публикаций одного исходного чата: строгий порядок внутри,
+    независимость от остальных чатов (долгий OCR-альбом не держит чужие посты)."""
+    chat_id: int
+    heap: List[Tuple[int, int, Payload]] = field(default_factory=list)  # (seq, tie, payload)
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    worker: Optional[asyncio.Task] = None
+    published: int = 0
+    latency_ms_total: float = 0.0
+    latency_ms_max: float = 0.0
+
+_lanes: Dict[int, PublishLane] = {}
 _heap_tie = 0
+_reorder_stats = {"released": 0, "held": 0, "forced": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
 
 def calc_seq_by_first_mid(first_mid: int) -> int:
     return int(first_mid)
@@ -150,67 +912,413 @@ def is_ocr_enabled_for(user_id: int) -> bool:
         return True
     return FILTER_PRICETAGS_IN_ALBUMS
 
-async def _do_publish(user_id: int, items: List[Dict[str, Any]], caption: str, album_ocr_on: bool):
+# ====== МАРШРУТЫ И ОЧЕРЕДИ ОТПРАВКИ ПО ВИТРИНАМ ======
+def _load_routes(raw: str) -> Dict[str, List[int]]:
+    routes: Dict[str, List[int]] = {"default": [TARGET_CHAT_ID]}
+    if not raw:
+        return routes
+    try:
+        for key, targets in json.loads(raw).items():
+            if isinstance(targets, (int, str)):
+                targets = [targets]
+            routes[str(key)] = [int(t) for t in targets]
+    except Exception as e:
+        print("TARGET_ROUTES parse failed:", repr(e))
+    return routes
+
+ROUTES = _load_routes(TARGET_ROUTES)
+
+def targets_for(chat_id: int, user_id: int) -> List[int]:
+    mode_key = active_mode.get(user_id, "sale")
+    return ROUTES.get(f"chat:{chat_id}") or ROUTES.get(f"mode:{mode_key}") or ROUTES["default"]
+
+@dataclass
+class SendJob:
+    """Готовая к отправке публикация: один и тот же job уходит во все витрины маршрута."""
+    cost: int                       # сколько сообщений списать из лимитов (альбом = N)
+    method: str                     # имя метода Bot: send_message / send_photo / ...
+    kwargs: Dict[str, Any]          # аргументы без chat_id
+    fallback_text: str = ""         # если forward_message не удался
+    enqueued_at: float = field(default_factory=time.monotonic)
+    pid: str = ""                   # id публикации в долговременном состоянии
+    trace: str = ""
+
+@dataclass
+class TargetOutbox:
+    """Своя очередь у каждой витрины: свой порядок и свой бюджет лимитов,
+    медленная (RetryAfter) витрина не задерживает остальные."""
+    chat_id: int
+    queue: "asyncio.Queue[SendJob]" = field(default_factory=asyncio.Queue)
+    worker: Optional[asyncio.Task] = None
+    sent: int = 0
+    failed: int = 0
+
+_outboxes: Dict[int, TargetOutbox] = {}
+
+async def _outbox_worker(box: TargetOutbox):
+    while True:
+        job = await box.queue.get()
+        waited = time.monotonic() - job.enqueued_at
+        M_OUTBOX_WAIT.observe(waited)
+        _trace_id.set(job.trace)
+        try:
+            with trace_span("send", target=box.chat_id, method=job.method, queue_ms=round(waited * 1000, 2)):
+                await tg_send(box.chat_id, job.cost, getattr(bot, job.method), chat_id=box.chat_id, **job.kwargs)
+            box.sent += 1
+        except Exception as e:
+            if job.fallback_text:
+                try:
+                    await tg_send(box.chat_id, 1, bot.send_message, chat_id=box.chat_id, text=job.fallback_text)
+                    box.sent += 1
+                except Exception as e2:
+                    box.failed += 1
+                    M_PUBLISH_ERRORS.inc()
+                    print(f"PUBLISH ERROR [{box.chat_id}]:", repr(e2))
+            elif job.method != "forward_message":
+                box.failed += 1
+                M_PUBLISH_ERRORS.inc()
+                print(f"PUBLISH ERROR [{box.chat_id}]:", repr(e))
+        finally:
+            _payload_target_done(job.pid, box.chat_id)
+            box.queue.task_done()
+
+def _get_outbox(chat_id: int) -> TargetOutbox:
+    box = _outboxes.get(chat_id)
+    if box is None:
+        box = _outboxes[chat_id] = TargetOutbox(chat_id=chat_id)
+    if box.worker is None or box.worker.done():
+        box.worker = asyncio.create_task(_outbox_worker(box))
+    return box
+
+def outboxes_stats_line() -> str:
+    if not _outboxes:
+        return "Витрины: отправок ещё не было"
+    return "Витрины:\n" + "\n".join(
+        f"• {b.chat_id}: в очереди {b.queue.qsize()}, отправлено {b.sent}, ошибок {b.failed}"
+        for b in _outboxes.values()
+    )
+
+async def _build_send_job(items: Sequence[MediaItem], caption: str, album_ocr_on: bool) -> Optional[SendJob]:
     if not items:
-        return
+        return None
 
-    if items and items[0].get("kind") == "forward":
+    if items[0].kind is MediaKind.FORWARD:
         it = items[0]
-        try:
-            await bot.forward_message(
-                chat_id=TARGET_CHAT_ID,
-                from_chat_id=it["from_chat_id"],
-                message_id=it["mid"],
-            )
-        except Exception:
-            if caption:
-                await bot.send_message(TARGET_CHAT_ID, caption)
-        return
+        return SendJob(1, "forward_message", {"from_chat_id": it.from_chat_id, "message_id": it.mid},
+                       fallback_text=caption)
 
-    if items and items[0].get("kind") == "text":
-        await bot.send_message(TARGET_CHAT_ID, caption or "")
-        return
+    if items[0].kind is MediaKind.TEXT:
+        return SendJob(1, "send_message", {"text": caption or ""})
 
     items = await filter_pricetag_media(items, album_ocr_on)
 
     if len(items) == 1:
         it = items[0]
-        if it["kind"] == "video":
-            await bot.send_video(TARGET_CHAT_ID, it["fid"], caption=caption)
-        else:
-            await bot.send_photo(TARGET_CHAT_ID, it["fid"], caption=caption)
-        return
+        if it.kind is MediaKind.VIDEO:
+            return SendJob(1, "send_video", {"video": it.fid, "caption": caption})
+        return SendJob(1, "send_photo", {"photo": it.fid, "caption": caption})
 
     first = items[0]
     media = []
-    if first["kind"] == "video":
-        media.append(InputMediaVideo(media=first["fid"], caption=caption, parse_mode=ParseMode.HTML))
+    if first.kind is MediaKind.VIDEO:
+        media.append(InputMediaVideo(media=first.fid, caption=caption, parse_mode=ParseMode.HTML))
     else:
-        media.append(InputMediaPhoto(media=first["fid"], caption=caption, parse_mode=ParseMode.HTML))
+        media.append(InputMediaPhoto(media=first.fid, caption=caption, parse_mode=ParseMode.HTML))
     for it in items[1:]:
-        media.append(InputMediaVideo(media=it["fid"]) if it["kind"] == "video" else InputMediaPhoto(media=it["fid"]))
-    await bot.send_media_group(TARGET_CHAT_ID, media)
+        media.append(InputMediaVideo(media=it.fid) if it.kind is MediaKind.VIDEO else InputMediaPhoto(media=it.fid))
+    # альбом в лимитах Telegram считается как len(media) сообщений
+    return SendJob(len(media), "send_media_group", {"media": media})
 
-async def publish_worker():
-    global _heap_tie
+# неотправленные публикации: pid → запись в state (вместе со списком витрин, куда уже ушло)
+_payload_records: Dict[str, Dict[str, Any]] = {}
+
+def _persist_payload(pid: str, rec: Dict[str, Any]):
+    state.put("payload", pid, {k: (_items_to_state(v) if k == "items" else v) for k, v in rec.items() if k != "left"})
+
+def _payload_target_done(pid: str, target: int):
+    rec = _payload_records.get(pid)
+    if rec is None:
+        return
+    rec["done"].append(target)
+    rec["left"] -= 1
+    if rec["left"] <= 0:
+        del _payload_records[pid]
+        state.delete("payload", pid)
+    else:
+        _persist_payload(pid, rec)
+
+async def _do_publish(chat_id: int, user_id: int, items: Sequence[MediaItem], caption: str, album_ocr_on: bool,
+                      pid: str = "", targets: Sequence[int] = ()):
+    # разбор и OCR-фильтр — один раз, отправка — в очередь каждой витрины маршрута
+    rec = _payload_records.get(pid)
+    done = set(rec["done"]) if rec else set()
+    # маршрут — снимок из publish_to_target; пересчёт только для записей state без него
+    targets = [t for t in (targets or targets_for(chat_id, user_id)) if t not in done]
+    job = None
+    if targets:
+        with trace_span("build_job", chat=chat_id, items=len(items)) as sp:
+            job = await _build_send_job(items, caption, album_ocr_on)
+            sp["method"] = job.method if job else None
+    if job is None:
+        _payload_records.pop(pid, None)
+        state.delete("payload", pid)
+        return
+    job.pid = pid
+    job.trace = _trace_id.get()
+    if rec:
+        rec["left"] = len(targets)
+    for target in targets:
+        _get_outbox(target).queue.put_nowait(job)
+
+def pending_floor(chat_id: int) -> Optional[int]:
+    """Наименьший message_id в чате, который ещё может превратиться в публикацию:
+    незакрытые альбомы, медиа в ожидании текста, партии «текст-эмодзи + медиа»."""
+    mids: List[int] = []
+    for _, mgid in album_index.get(chat_id, ()):
+        buf = album_buffers.get((chat_id, mgid))
+        if buf and buf.get("items"):
+            mids.append(buf["items"][0].mid)
+    bucket = last_media.get(chat_id)
+    if bucket and bucket.get("items") and datetime.now() - bucket["ts"] <= timedelta(seconds=ALBUM_WINDOW_SECONDS):
+        mids.append(bucket.get("first_mid") or min(map(mid_of, bucket["items"])))
+    for rec in batches.get(chat_id, ()):
+        if rec.text_msg:
+            mids.append(rec.text_msg.message_id)
+        mids.extend(map(mid_of, rec.media))
+    return min(mids) if mids else None
+
+def _pop_ready_payload(lane: PublishLane) -> Optional[Payload]:
+    """Голова полосы готова, если раньше неё в этом чате уже ничего не может прийти
+    (водяной знак), либо она ждёт дольше REORDER_MAX_HOLD_MS."""
+    if not lane.heap:
+        return None
+    now = time.monotonic()
+    seq, _, pl = lane.heap[0]
+    floor = pending_floor(lane.chat_id)
+    forced = False
+    if floor is not None and floor < seq:
+        if (now - pl.enqueued_at) * 1000 < REORDER_MAX_HOLD_MS:
+            return None
+        forced = True
+    heapq.heappop(lane.heap)
+    waited_ms = (now - pl.enqueued_at) * 1000
+    M_LANE_WAIT.observe(waited_ms / 1000)
+    st = _reorder_stats
+    st["released"] += 1
+    if waited_ms >= REORDER_TICK_MS:
+        st["held"] += 1
+        st["wait_ms_total"] += waited_ms
+        st["wait_ms_max"] = max(st["wait_ms_max"], waited_ms)
+    if forced:
+        st["forced"] += 1
+        print(f"REORDER: chat {lane.chat_id} mid {pl.first_mid} отпущен по таймауту после {waited_ms:.0f} ms")
+    return pl
+
+def reorder_stats_line() -> str:
+    st = _reorder_stats
+    avg = st["wait_ms_total"] / st["held"] if st["held"] else 0.0
+    return (f"Порядок публикаций: отпущено {st['released']}, ждали {st['held']} "
+            f"(в среднем {avg:.0f} ms, максимум {st['wait_ms_max']:.0f} ms), по таймауту {st['forced']}")
+
+def lanes_stats_line() -> str:
+    if not _lanes:
+        return "Полосы публикации: нет активных"
+    rows = [f"Полосы публикации: {len(_lanes)}"]
+    for lane in sorted(_lanes.values(), key=lambda l: -len(l.heap)):
+        avg = lane.latency_ms_total / lane.published if lane.published else 0.0
+        rows.append(f"• чат {lane.chat_id}: в очереди {len(lane.heap)}, опубликовано {lane.published}, "
+                    f"задержка ср. {avg:.0f} ms / макс. {lane.latency_ms_max:.0f} ms")
+    return "\n".join(rows)
+
+async def _lane_worker(lane: PublishLane):
     while True:
-        payload = await publish_queue.get()
-        seq = payload[0]
-        _heap_tie += 1
-        heapq.heappush(_heap, (seq, _heap_tie, payload))
-        publish_queue.task_done()
-        while _heap:
-            _, _, pl = heapq.heappop(_heap)
-            _seq, first_mid, user_id, items, caption, album_ocr_on = pl
+        pl = _pop_ready_payload(lane)
+        if pl is None:
+            lane.wakeup.clear()
+            # пусто — ждём новых постов, есть отложенные — перепроверяем водяной знак по тику
+            timeout = REORDER_TICK_MS / 1000 if lane.heap else LANE_IDLE_S
             try:
-                await _do_publish(user_id, items, caption, album_ocr_on)
-            except Exception as e:
-                print("PUBLISH ERROR:", repr(e))
+                await asyncio.wait_for(lane.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                if not lane.heap:
+                    # полоса простаивает — освобождаем (новый пост создаст её заново)
+                    _lanes.pop(lane.chat_id, None)
+                    return
+            continue
+        _trace_id.set(pl.trace)
+        trace_event("lane.wait", chat=pl.chat_id, mid=pl.first_mid, ms=round((time.monotonic() - pl.enqueued_at) * 1000, 2))
+        # общего лимита на полосы нет: OCR-фильтр ограничен _ocr_slots (по задачам, а не по альбомам),
+        # отправка — очередями витрин, так что альбом с OCR не держит публикации других чатов
+        try:
+            await _do_publish(pl.chat_id, pl.user_id, pl.items, pl.caption, pl.album_ocr_on, pl.pid, pl.targets)
+        except Exception as e:
+            M_PUBLISH_ERRORS.inc()
+            print("PUBLISH ERROR:", repr(e))
+        latency_ms = (time.monotonic() - pl.enqueued_at) * 1000
+        lane.published += 1
+        lane.latency_ms_total += latency_ms
+        lane.latency_ms_max = max(lane.latency_ms_max, latency_ms)
+
+def _get_lane(chat_id: int) -> PublishLane:
+    lane = _lanes.get(chat_id)
+    if lane is None:
+        lane = _lanes[chat_id] = PublishLane(chat_id=chat_id)
+    if lane.worker is None or lane.worker.done():
+        lane.worker = asyncio.create_task(_lane_worker(lane))
+    return lane
+
+def _enqueue_payload(rec: Dict[str, Any], pid: str):
+    global _heap_tie
+    _payload_records[pid] = dict(rec, left=0)
+    _persist_payload(pid, rec)
+    lane = _get_lane(rec["chat_id"])
+    _heap_tie += 1
+    heapq.heappush(lane.heap, (rec["seq"], _heap_tie, Payload(
+        rec["seq"], rec["chat_id"], rec["first_mid"], rec["user_id"], tuple(rec["items"]), rec["caption"],
+        rec["album_ocr_on"], time.monotonic(), pid, rec.get("trace", ""), tuple(rec.get("targets") or ()),
+    )))
+    lane.wakeup.set()
+
+gauge("publish_lane_backlog", "Публикации в полосах (ждут порядка)", lambda: sum(len(l.heap) for l in _lanes.values()))
+gauge("outbox_backlog", "Отправки в очередях витрин", lambda: sum(b.queue.qsize() for b in _outboxes.values()))
+
+async def publish_to_target(chat_id: int, first_mid: int, user_id: int, items: Sequence[MediaItem], caption: str):
+    rec = {
+        "seq": calc_seq_by_first_mid(first_mid), "chat_id": chat_id, "first_mid": first_mid, "user_id": user_id,
+        "items": items, "caption": caption, "album_ocr_on": is_ocr_enabled_for(user_id), "done": [],
+        "trace": _trace_id.get(), "targets": targets_for(chat_id, user_id),
+    }
+    trace_event("enqueue", chat=chat_id, mid=first_mid, items=len(items))
+    _enqueue_payload(rec, uuid.uuid4().hex)
+
+# ====== КЭШИ ======
+class TTLCache:
+    """Простой LRU с TTL (ttl=0 — без срока жизни) и счётчиками попаданий."""
+    def __init__(self, max_entries: int, ttl_s: float = 0.0):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        rec = self._data.get(key)
+        if rec is None or (self.ttl_s and time.time() - rec[0] > self.ttl_s):
+            if rec is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return rec[1]
+
+    def put(self, key, value, ts: Optional[float] = None):
+        self._data[key] = (ts if ts is not None else time.time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        rec = self._data.pop(key, None)
+        return default if rec is None else rec[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0.0
+        return f"{len(self._data)}/{self.max_entries} шт., попаданий {self.hits}, промахов {self.misses} ({rate:.0f}%)"
+
+# --- Вердикты OCR: память (LRU+TTL) поверх SQLite ---
+# значение: (engine, text, found)
+OcrVerdict = Tuple[str, str, bool]
+_ocr_mem_cache = TTLCache(OCR_CACHE_MEM_MAX, OCR_CACHE_TTL_H * 3600)
+_ocr_disk_hits = 0
+_ocr_db: Optional[sqlite3.Connection] = None
+_ocr_db_lock = threading.Lock()
+
+def _ocr_db_conn() -> Optional[sqlite3.Connection]:
+    global _ocr_db
+    if _ocr_db is None and OCR_CACHE_PATH:
+        try:
+            conn = sqlite3.connect(OCR_CACHE_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_verdicts ("
+                " uid TEXT PRIMARY KEY, engine TEXT, text TEXT, found INTEGER, ts REAL)"
+            )
+            conn.execute("DELETE FROM ocr_verdicts WHERE ts < ?", (time.time() - OCR_CACHE_TTL_H * 3600,))
+            conn.commit()
+            _ocr_db = conn
+        except Exception as e:
+            print("OCR CACHE DB init failed:", repr(e))
+    return _ocr_db
+
+def _ocr_db_get(uid: str) -> Optional[Tuple[OcrVerdict, float]]:
+    with _ocr_db_lock:
+        conn = _ocr_db_conn()
+        if conn is None:
+            return None
+        row = conn.execute("SELECT engine, text, found, ts FROM ocr_verdicts WHERE uid = ?", (uid,)).fetchone()
+    if not row or time.time() - row[3] > OCR_CACHE_TTL_H * 3600:
+        return None
+    return (row[0], row[1], bool(row[2])), row[3]
+
+def _ocr_db_put(uid: str, verdict: OcrVerdict, ts: float):
+    with _ocr_db_lock:
+        conn = _ocr_db_conn()
+        if conn is None:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_verdicts (uid, engine, text, found, ts) VALUES (?, ?, ?, ?, ?)",
+            (uid, verdict[0], verdict[1], int(verdict[2]), ts),
+        )
+        conn.commit()
+
+async def ocr_cache_get(uid: str) -> Optional[OcrVerdict]:
+    global _ocr_disk_hits
+    if not uid:
+        return None
+    v = _ocr_mem_cache.get(uid)
+    if v is not None:
+        return v
+    try:
+        rec = await asyncio.to_thread(_ocr_db_get, uid)
+    except Exception as e:
+        print("OCR CACHE DB read failed:", repr(e))
+        rec = None
+    if rec is None or rec[0][0] == "PRE":  # старые записи предфильтра — не вердикт OCR
+        return None
+    verdict, ts = rec
+    _ocr_disk_hits += 1
+    _ocr_mem_cache.put(uid, verdict, ts=ts)
+    return verdict
+
+async def ocr_cache_put(uid: str, verdict: OcrVerdict):
+    if not uid:
+        return
+    ts = time.time()
+    _ocr_mem_cache.put(uid, verdict, ts=ts)
+    try:
+        await asyncio.to_thread(_ocr_db_put, uid, verdict, ts)
+    except Exception as e:
+        print("OCR CACHE DB write failed:", repr(e))
 
-async def publish_to_target(first_mid: int, user_id: int, items: List[Dict[str, Any]], caption: str):
-    album_ocr_on = is_ocr_enabled_for(user_id)
-    seq = calc_seq_by_first_mid(first_mid)
-    await publish_queue.put((seq, first_mid, user_id, items, caption, album_ocr_on))
+def ocr_cache_stats_line() -> str:
+    # промах памяти, найденный на диске, — тоже попадание
+    hits = _ocr_mem_cache.hits + _ocr_disk_hits
+    misses = _ocr_mem_cache.misses - _ocr_disk_hits
+    total = hits + misses
+    rate = (100.0 * hits / total) if total else 0.0
+    return (f"OCR-кэш: попаданий {hits} (с диска {_ocr_disk_hits}), промахов {misses}, "
+            f"hit rate {rate:.0f}%, в памяти {len(_ocr_mem_cache)}")
 
 # ====== OCR ======
 GV_CLIENT = None
@@ -231,6 +1339,14 @@ if OCR_ENABLED and VISION_JSON:
         GV_CLIENT = None
         print("Google Vision init failed:", repr(e))
 
+PIL_AVAILABLE = False
+if OCR_ENABLED:
+    try:
+        from PIL import Image  # noqa
+        PIL_AVAILABLE = True
+    except Exception as e:
+        print("Pillow not available:", repr(e))
+
 TESS_AVAILABLE = False
 if OCR_ENABLED:
     try:
@@ -265,9 +1381,11 @@ def _preprocess_for_tesseract(img):
     return g
 
 async def _load_bytes(file_id: str) -> bytes:
+    t0 = time.perf_counter()
     file = await bot.get_file(file_id)
     buf = io.BytesIO()
     await bot.download(file, buf)
+    M_OCR_DOWNLOAD.observe(time.perf_counter() - t0)
     return buf.getvalue()
 
 def _ocr_google_vision(data: bytes) -> str:
@@ -285,6 +1403,83 @@ def _ocr_google_vision(data: bytes) -> str:
         print("GV EXC:", repr(e))
         return ""
 
+# --- Предфильтр: статистика уменьшенного кадра + dHash ---
+def _dhash(gray) -> int:
+    from PIL import Image
+    px = gray.resize((9, 8), Image.BILINEAR).tobytes()
+    h = 0
+    for y in range(8):
+        row = px[y * 9:(y + 1) * 9]
+        for x in range(8):
+            h = (h << 1) | (row[x] > row[x + 1])
+    return h
+
+def _precheck_pricetag(data: bytes) -> Tuple[str, int]:
+    """("no", hash) — точно не ценник (почти нет контуров/строк текста), иначе ("maybe", hash).
+    hash сверяется с библиотекой макетов: совпадение отправляет кадр в OCR даже при "no"."""
+    try:
+        from PIL import Image, ImageFilter
+        img = Image.open(io.BytesIO(data))
+        img.draft("L", (PRECHECK_SIZE * 2, PRECHECK_SIZE * 2))  # JPEG декодируется сразу уменьшенным
+        g = img.convert("L")
+        g.thumbnail((PRECHECK_SIZE, PRECHECK_SIZE))
+        dh = _dhash(g)
+        w, h = g.size
+        edges = g.filter(ImageFilter.FIND_EDGES).crop((1, 1, w - 1, h - 1))  # рамка даёт ложные контуры
+        w, h = edges.size
+        px = edges.point(lambda v: 255 if v >= 48 else 0).tobytes()
+        edge_share = px.count(255) / float(w * h)
+        # строка «похожа на текст», если в ней много отдельных штрихов (переходов фон→контур)
+        text_rows = sum(1 for y in range(h) if px[y * w:(y + 1) * w].count(b"\x00\xff") >= 4) / float(h)
+        if edge_share < PRECHECK_MIN_EDGE or text_rows < PRECHECK_MIN_TEXT_ROWS:
+            return ("no", dh)
+        return ("maybe", dh)
+    except Exception as e:
+        print("PRECHECK EXC:", repr(e))
+        return ("maybe", 0)
+
+def _load_pricetag_hashes() -> List[int]:
+    out: List[int] = []
+    if not PRICETAG_HASHES_PATH or not os.path.exists(PRICETAG_HASHES_PATH):
+        return out
+    try:
+        with open(PRICETAG_HASHES_PATH, encoding="utf-8") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    out.append(int(line, 16))
+    except Exception as e:
+        print("PRICETAG HASHES load failed:", repr(e))
+    return out[-PRICETAG_HASHES_MAX:]
+
+_pricetag_hashes: List[int] = _load_pricetag_hashes()
+_precheck_stats = {"no": 0, "layout": 0, "maybe": 0}
+# «нет» предфильтра — эвристика, в постоянный кэш OCR её не пишем: только в память и вместе с dHash,
+# чтобы ценник, позже добавленный в библиотеку макетов, всё-таки ушёл в OCR
+_precheck_no = TTLCache(OCR_CACHE_MEM_MAX, 6 * 3600)
+
+def _matches_known_pricetag(dh: int) -> bool:
+    return bool(dh) and any(bin(dh ^ k).count("1") <= PRICETAG_HASH_MAX_DIST for k in _pricetag_hashes)
+
+def _learn_pricetag_hash(dh: int):
+    # подтверждённый OCR ценник пополняет библиотеку макетов
+    if not dh or _matches_known_pricetag(dh):
+        return
+    _pricetag_hashes.append(dh)
+    del _pricetag_hashes[:-PRICETAG_HASHES_MAX]
+    if PRICETAG_HASHES_PATH:
+        try:
+            with open(PRICETAG_HASHES_PATH, "a", encoding="utf-8") as f:
+                f.write(f"{dh:016x}\n")
+        except Exception as e:
+            print("PRICETAG HASHES save failed:", repr(e))
+
+def precheck_stats_line() -> str:
+    avoided = _precheck_stats["no"]
+    total = avoided + _precheck_stats["layout"] + _precheck_stats["maybe"]
+    return (f"Предфильтр: OCR не понадобился {avoided} из {total}, "
+            f"в OCR по макету ценника {_precheck_stats['layout']}, библиотека макетов {len(_pricetag_hashes)}")
+
 def _ocr_tesseract(data: bytes) -> str:
     if not TESS_AVAILABLE:
         return ""
@@ -300,13 +1495,83 @@ def _ocr_tesseract(data: bytes) -> str:
         print("TESS EXC:", repr(e))
         return ""
 
-def _ocr_extract_text(data: bytes) -> Tuple[str, str]:
+# --- Исполнители OCR (создаются лениво, уже внутри запущенного loop) ---
+_ocr_proc_pool: Optional[ProcessPoolExecutor] = None
+_ocr_thread_pool: Optional[ThreadPoolExecutor] = None
+_ocr_slots = asyncio.Semaphore(max(1, OCR_QUEUE_MAX))
+
+def _ocr_get_thread_pool() -> ThreadPoolExecutor:
+    global _ocr_thread_pool
+    if _ocr_thread_pool is None:
+        _ocr_thread_pool = ThreadPoolExecutor(max_workers=max(1, OCR_THREAD_WORKERS), thread_name_prefix="ocr")
+    return _ocr_thread_pool
+
+def _ocr_get_tess_pool():
+    global _ocr_proc_pool
+    if OCR_PROCESS_WORKERS <= 0:
+        return _ocr_get_thread_pool()
+    if _ocr_proc_pool is None:
+        _ocr_proc_pool = ProcessPoolExecutor(max_workers=OCR_PROCESS_WORKERS)
+    return _ocr_proc_pool
+
+def ocr_shutdown():
+    global _ocr_proc_pool, _ocr_thread_pool
+    if _ocr_proc_pool is not None:
+        _ocr_proc_pool.shutdown(wait=False, cancel_futures=True)
+        _ocr_proc_pool = None
+    if _ocr_thread_pool is not None:
+        _ocr_thread_pool.shutdown(wait=False, cancel_futures=True)
+        _ocr_thread_pool = None
+
+async def _run_ocr_job(pool, fn: Callable[[bytes], Any], data: bytes, default: Any = ""):
+    """Запускает fn(data) в пуле: не больше OCR_QUEUE_MAX задач сразу, с таймаутом.
+    Слот держится, пока задача реально не закончится в пуле: по таймауту/отмене ещё не начатая
+    задача снимается из очереди, а уже идущая занимает слот до конца — пул не переполняется."""
+    global _ocr_proc_pool
+    loop = asyncio.get_running_loop()
+    await _ocr_slots.acquire()
+    try:
+        cfut = pool.submit(fn, data)
+    except BrokenProcessPool as e:
+        # воркер упал (в т.ч. уже после таймаута своей задачи) — пул пересоздадим при следующей задаче
+        _ocr_slots.release()
+        print("OCR POOL BROKEN:", repr(e))
+        if pool is _ocr_proc_pool:
+            _ocr_proc_pool = None
+        return default
+    except BaseException:
+        _ocr_slots.release()
+        raise
+    cfut.add_done_callback(lambda _: loop.call_soon_threadsafe(_ocr_slots.release))
+    afut = asyncio.wrap_future(cfut)
+    afut.add_done_callback(lambda f: f.cancelled() or f.exception())  # результат после таймаута никому не нужен
+    try:
+        return await asyncio.wait_for(asyncio.shield(afut), OCR_JOB_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        cfut.cancel()
+        print(f"OCR TIMEOUT: {fn.__name__} > {OCR_JOB_TIMEOUT_S}s")
+        return default
+    except asyncio.CancelledError:
+        cfut.cancel()
+        raise
+    except BrokenProcessPool as e:
+        # упавший воркер ломает весь пул — пересоздадим при следующей задаче
+        print("OCR POOL BROKEN:", repr(e))
+        if pool is _ocr_proc_pool:
+            _ocr_proc_pool = None
+        return default
+
+async def _ocr_extract_text(data: bytes) -> Tuple[str, str]:
     if GV_CLIENT:
-        t = _ocr_google_vision(data)
+        t0 = time.perf_counter()
+        t = await _run_ocr_job(_ocr_get_thread_pool(), _ocr_google_vision, data)
+        M_OCR.observe(time.perf_counter() - t0, engine="GV")
         if t:
             return ("GV", t)
     if TESS_AVAILABLE:
-        t = _ocr_tesseract(data)
+        t0 = time.perf_counter()
+        t = await _run_ocr_job(_ocr_get_tess_pool(), _ocr_tesseract, data)
+        M_OCR.observe(time.perf_counter() - t0, engine="TESS")
         if t:
             return ("TESS", t)
     return ("", "")
@@ -320,33 +1585,101 @@ def _looks_like_price_text(text: str) -> bool:
     has_basic = ("€" in text or "eur" in low or "euro" in low) and bool(re.search(r"\d", text))
     return has_token or (has_kw and bool(re.search(r"\d", text))) or has_basic
 
-async def ocr_should_hide(file_id: str) -> bool:
+def _ocr_download_ladder(file_id: str, sizes: Optional[List[Tuple[str, int, int]]]) -> List[str]:
+    """Что качать для OCR: наименьший размер с площадью >= OCR_MIN_PIXELS, затем (если текста нет) наибольший."""
+    if not sizes:
+        return [file_id]
+    pick = next((fid for fid, w, h in sizes if w * h >= OCR_MIN_PIXELS), sizes[-1][0])
+    return [pick] if pick == sizes[-1][0] else [pick, sizes[-1][0]]
+
+async def ocr_should_hide(file_id: str, file_unique_id: str = "",
+                          sizes: Optional[List[Tuple[str, int, int]]] = None) -> bool:
     if not OCR_ENABLED:
         return False
     try:
-        data = await _load_bytes(file_id)
-        engine, txt = _ocr_extract_text(data)
+        cached = await ocr_cache_get(file_unique_id)
+        if cached is not None:
+            engine, txt, found = cached
+            print(f"OCR[{engine}/CACHE] {'FOUND' if found else 'NOT_FOUND'}")
+            return found
+        pre_dh = _precheck_no.get(file_unique_id) if file_unique_id else None
+        if pre_dh is not None and not _matches_known_pricetag(pre_dh):
+            print("OCR[PRE/CACHE] NOT_FOUND")
+            return False
+        ladder = _ocr_download_ladder(file_id, sizes)
+        data = await _load_bytes(ladder[0])
+        dh = 0
+        if PRECHECK_ENABLED and PIL_AVAILABLE:
+            verdict, dh = await _run_ocr_job(_ocr_get_tess_pool(), _precheck_pricetag, data, default=("maybe", 0))
+            if verdict == "no" and _matches_known_pricetag(dh):
+                # похоже на известный макет ценника — статистике не верим, отдаём в OCR
+                _precheck_stats["layout"] += 1
+            elif verdict == "no":
+                _precheck_stats["no"] += 1
+                if file_unique_id:
+                    _precheck_no.put(file_unique_id, dh)
+                print("OCR[PRE] NOT_FOUND")
+                return False
+            else:
+                _precheck_stats["maybe"] += 1
+        engine, txt = await _ocr_extract_text(data)
+        for bigger in ladder[1:]:
+            if txt:
+                break
+            # на маленькой копии текста не нашлось — пробуем полный размер
+            data = await _load_bytes(bigger)
+            engine, txt = await _ocr_extract_text(data)
         if not txt:
+            # пустой результат не кэшируем: это мог быть таймаут или сбой движка
             print(f"OCR[{engine or 'NONE'}] NOT_FOUND")
             return False
         found = _looks_like_price_text(txt)
-        print(f"OCR[{engine}] {'FOUND' if found else 'NOT_FOUND'} :: {txt[:120].replace(chr(10),' ')}")
+        await ocr_cache_put(file_unique_id, (engine, txt, found))
+        if found:
+            _learn_pricetag_hash(dh)
+        print(f"OCR[{engine}] {'FOUND' if found else 'NOT_FOUND'} ({len(data) // 1024} KB) :: {txt[:120].replace(chr(10),' ')}")
         return found
     except Exception as e:
         print("OCR ERROR:", repr(e))
         return False
 
-async def filter_pricetag_media(items: List[Dict[str, Any]], album_ocr_on: bool) -> List[Dict[str, Any]]:
+async def _ocr_item(it: MediaItem, sem: asyncio.Semaphore) -> bool:
+    async with sem:
+        return await ocr_should_hide(it.fid, it.uid, it.sizes)
+
+def _start_speculative_ocr(it: MediaItem, sem: asyncio.Semaphore):
+    """Запускает скачивание+OCR кадра сразу при приёме — пока альбом «отстаивается»."""
+    if OCR_ENABLED and it.kind is MediaKind.PHOTO and it.ocr is None:
+        it.ocr = asyncio.create_task(_ocr_item(it, sem))
+
+def _cancel_speculative_ocr(items: Sequence[MediaItem]):
+    for it in items:
+        task, it.ocr = it.ocr, None
+        if task is not None and not task.done():
+            task.cancel()
+
+async def filter_pricetag_media(items: Sequence[MediaItem], album_ocr_on: bool) -> Sequence[MediaItem]:
     if len(items) == 1 or not album_ocr_on:
+        _cancel_speculative_ocr(items)
         return items
-    kept: List[Dict[str, Any]] = []
-    for it in items:
-        if it["kind"] == "photo":
-            hide = await ocr_should_hide(it["fid"])
-            if not hide:
-                kept.append(it)
-        else:
-            kept.append(it)
+    t0 = time.perf_counter()
+    sem = asyncio.Semaphore(max(1, OCR_ALBUM_CONCURRENCY))
+
+    async def _check(it: MediaItem) -> bool:
+        if it.kind is not MediaKind.PHOTO:
+            return False
+        task, it.ocr = it.ocr, None
+        if task is not None:
+            # результат уже посчитан (или досчитывается) с момента приёма кадра
+            return await task
+        return await _ocr_item(it, sem)
+
+    # gather сохраняет порядок результатов — kept остаётся в исходном порядке mid
+    hidden = await asyncio.gather(*(_check(it) for it in items))
+    kept = [it for it, hide in zip(items, hidden) if not hide]
+    M_OCR_HIDDEN.inc(sum(hidden))
+    print(f"OCR ALBUM: {len(items)} items, hidden {sum(hidden)}, {(time.perf_counter() - t0) * 1000:.0f} ms")
+    trace_event("ocr.filter", items=len(items), hidden=sum(hidden), ms=round((time.perf_counter() - t0) * 1000, 2))
     return kept if kept else items[:1]
 
 # ====== КАЛЬКУЛЯТОРЫ ======
@@ -372,11 +1705,169 @@ def lux_calc(price: float, discount: int) -> int:
         final = discounted * 1.10 + 30
     return ceil_price(final)
 
+# Те же ступени для массива цен разом (импорт прайсов); без NumPy — поштучно
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+def _ceil_price_vec(values):
+    return np.ceil(values - 1e-9).astype(np.int64)
+
+def default_calc_vec(prices, discounts):
+    discounted = prices * (1 - discounts / 100)
+    return _ceil_price_vec(np.where(discounted <= 250, discounted + 55,
+                                    np.where(discounted <= 400, discounted + 70, discounted + 90)))
+
+def lux_calc_vec(prices, discounts):
+    discounted = prices * (1 - discounts / 100)
+    return _ceil_price_vec(np.where(discounted <= 250, discounted + 55,
+                                    np.where(discounted <= 400, discounted + 70, discounted * 1.10 + 30)))
+
+VECTOR_CALCS: Dict[Callable[[float, int], int], Callable] = {default_calc: default_calc_vec, lux_calc: lux_calc_vec}
+
+def calc_many(calc_fn: Callable[[float, int], int], prices: Sequence[float], discounts: Sequence[int]) -> List[int]:
+    vec = VECTOR_CALCS.get(calc_fn) or getattr(calc_fn, "vec", None)
+    if NUMPY_AVAILABLE and vec is not None and len(prices):
+        return vec(np.asarray(prices, dtype=np.float64), np.asarray(discounts, dtype=np.int64)).tolist()
+    return [calc_fn(float(p), int(d)) for p, d in zip(prices, discounts)]
+
+# --- Формулы (/formula): правило цены → скомпилированная функция того же вида, что default_calc ---
+# «-%; ≤250 +55; ≤400 +70; +10% +30€»: -% (только в начале) — скидка из поста; «≤N»/«<N» — ступень,
+# первая подходящая побеждает, условие сравнивается с ценой после общих шагов; без условия в конце — «иначе».
+# Шаги: +N / -N (€), +N% / -N%, ×N. Каждая ветка сводится к x·a + b и генерируется в код один раз.
+FORMULA_DEFAULTS: Dict[Callable[[float, int], int], str] = {
+    default_calc: "-%; ≤250 +55; ≤400 +70; +90",
+    lux_calc: "-%; ≤250 +55; ≤400 +70; +10% +30",
+}
+
+_FORMULA_NUM = r"\d{1,6}(?:[.,]\d{1,4})?"
+_FORMULA_MAX_COEF = 1e6
+_FORMULA_COND_RE = re.compile(rf"(?P<op><=|≤|<|до)\s*(?P<lim>{_FORMULA_NUM})\s*(?:€|eur)?\s*:?", re.I)
+_FORMULA_OP_RE = re.compile(
+    rf"\s*(?:(?P<disc>-\s*%)|(?P<sign>[+\-−])\s*(?P<num>{_FORMULA_NUM})\s*(?P<unit>%|€|eur)?"
+    rf"|[*×xх]\s*(?P<mul>{_FORMULA_NUM}))",
+    re.I,
+)
+
+def _formula_num(s: str) -> float:
+    return float(s.replace(",", "."))
+
+def _formula_ops(text: str, allow_discount: bool) -> Tuple[bool, Tuple[float, float]]:
+    """Цепочка шагов → (была ли -%, (a, b)) для x·a + b."""
+    a, b, disc, pos = 1.0, 0.0, False, 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _FORMULA_OP_RE.match(text, pos)
+        if not m:
+            raise ValueError(f"не понимаю «{text[pos:].strip()}»")
+        if m.group("disc"):
+            if not allow_discount or pos or disc:
+                raise ValueError("-% ставится в самом начале формулы")
+            disc = True
+        elif m.group("mul"):
+            k = _formula_num(m.group("mul"))
+            a, b = a * k, b * k
+        else:
+            n = _formula_num(m.group("num")) * (-1 if m.group("sign") != "+" else 1)
+            if m.group("unit") == "%":
+                k = 1 + n / 100
+                a, b = a * k, b * k
+            else:
+                b += n
+        pos = m.end()
+    return disc, (a, b)
+
+def _affine_src(a: float, b: float, var: str = "x") -> str:
+    src = var if a == 1 else f"{var} * {a!r}"
+    if b:
+        src += f" + {b!r}" if b > 0 else f" - {-b!r}"
+    return src
+
+def normalize_formula(text: str) -> str:
+    return "; ".join(" ".join(p.split()) for p in re.split(r"[;\n]+", text or "") if p.strip())
+
+def _compile_formula_uncached(text: str) -> Callable[[float, int], int]:
+    parts = [p.strip() for p in text.split(";")]
+    if not parts or not parts[0]:
+        raise ValueError("пустая формула")
+    discount = False
+    prefix = (1.0, 0.0)
+    tiers: List[Tuple[str, float, float, float]] = []
+    otherwise: Optional[Tuple[float, float]] = None
+    for idx, part in enumerate(parts):
+        cond = _FORMULA_COND_RE.match(part)
+        disc, (a, b) = _formula_ops(part[cond.end():] if cond else part, allow_discount=idx == 0 and not cond)
+        discount = discount or disc
+        if cond:
+            if otherwise is not None:
+                raise ValueError("ступень после ветки «иначе»")
+            op = "<" if cond.group("op") == "<" else "<="
+            tiers.append((op, _formula_num(cond.group("lim")), a, b))
+        elif not tiers:
+            prefix = (prefix[0] * a, prefix[1] * a + b)
+        elif otherwise is None:
+            otherwise = (a, b)
+        else:
+            raise ValueError("две ветки «иначе»")
+    if not tiers:
+        prefix, otherwise = (1.0, 0.0), prefix
+    otherwise = otherwise or (1.0, 0.0)
+    # в код попадают только конечные числа разумного размера: repr(inf) → «inf» и NameError при вызове
+    coefs = [*prefix, *otherwise] + [v for _, lim, a, b in tiers for v in (lim, a, b)]
+    if not all(math.isfinite(v) and abs(v) <= _FORMULA_MAX_COEF for v in coefs):
+        raise ValueError("слишком большие множители или надбавки")
+
+    # генерируем код из уже проверенных чисел — вызов стоит как у default_calc
+    src = ["def calc(price, discount):",
+           "    x = price * (1 - discount / 100)" if discount else "    x = price"]
+    if prefix != (1.0, 0.0):
+        src.append(f"    x = {_affine_src(*prefix)}")
+    for op, lim, a, b in tiers:
+        src.append(f"    if x {op} {lim!r}:")
+        src.append(f"        return ceil_price({_affine_src(a, b)})")
+    src.append(f"    return ceil_price({_affine_src(*otherwise)})")
+    ns = {"ceil_price": ceil_price}
+    exec("\n".join(src), ns)
+    calc = ns["calc"]
+    calc.formula = text
+
+    if NUMPY_AVAILABLE:
+        def calc_vec(prices, discounts):
+            x = prices * (1 - discounts / 100) if discount else prices
+            x = x * prefix[0] + prefix[1]
+            conds = [(x < lim) if op == "<" else (x <= lim) for op, lim, _, _ in tiers]
+            return _ceil_price_vec(np.select(conds, [x * a + b for _, _, a, b in tiers], x * otherwise[0] + otherwise[1]))
+        calc.vec = calc_vec
+    return calc
+
+_formula_cache = TTLCache(256)
+
+def compile_formula(text: str) -> Callable[[float, int], int]:
+    """Разбор и компиляция правила (с кэшем по тексту); ValueError с понятной причиной, если правило неверно."""
+    text = normalize_formula(text)
+    calc = _formula_cache.get(text)
+    if calc is None:
+        calc = _compile_formula_uncached(text)
+        _formula_cache.put(text, calc)
+    return calc
+
+# (user_id, режим) → текст формулы; без записи действует calc режима
+mode_formulas: Dict[Tuple[int, str], str] = {}
+
 # ====== РАЗБОР И 5-СТРОЧНАЯ ПОДПИСЬ ======
+# Все шаблоны разбора компилируются один раз при импорте: на длинных прайсах
+# поиск шаблона в кэше re по строке стоил больше самого поиска.
+_HASHTAG_RE = re.compile(r"#\S+")
+_SPACES_RE = re.compile(r"[ \t]{2,}|\t")  # то же, что [ \t]+ → " ", но не трогает одиночные пробелы
+_MANY_NL_RE = re.compile(r"\n{3,}")
+
 def cleanup_text_basic(text: str) -> str:
-    text = re.sub(r"#\S+", "", text)
-    text = re.sub(r"[ \t]+", " ", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = _HASHTAG_RE.sub("", text)
+    text = _SPACES_RE.sub(" ", text)
+    text = _MANY_NL_RE.sub("\n\n", text)
     return text.strip()
 
 # === РАЗМЕРЫ ===
@@ -387,23 +1878,36 @@ SIZE_NUM_BAL = r"(?:[1-6])"
 SIZE_NUM_ANY = rf"(?:{SIZE_NUM_EU}|{SIZE_NUM_US}|{SIZE_NUM_BAL})"
 SIZE_TOKEN   = rf"(?:{SIZE_ALPHA}|{SIZE_NUM_ANY})"
 
+_SEASON_ANY_RE     = re.compile(r"\b(?:NEW\s+)?(?:FW|SS)\d+(?:/\d+)?\b", re.I)
+_SEASON_NEW_RE     = re.compile(r"\bNEW\s+(?:FW|SS)\d+(?:/\d+)?\b", re.I)
+_SEASON_RE         = re.compile(r"\b(?:FW|SS)\d+(?:/\d+)?\b", re.I)
+_DISCOUNT_STRIP_RE = re.compile(r"[–—\-−]\s?\d{1,2}\s?%")
+_SIZE_RANGE_DASH_RE  = re.compile(rf"(?<!\d)({SIZE_NUM_ANY})\s*[-–—]\s*({SIZE_NUM_ANY})(?!\d)")
+_SIZE_RANGE_SLASH_RE = re.compile(rf"(?<!\d)({SIZE_NUM_ANY})\s*/\s*({SIZE_NUM_ANY})(?!\d)")
+_SIZE_NUM_RE       = re.compile(rf"(?<!\d)({SIZE_NUM_ANY})(?!\d)")
+_SIZE_ALPHA_RE     = re.compile(rf"\b({SIZE_ALPHA})\b", re.I)
+_SIZE_NUM_LIST_RE  = re.compile(rf"(?<!\d){SIZE_NUM_ANY}(?:\s*(?:[,/]\s*{SIZE_NUM_ANY}))+?(?!\d)")
+_SIZE_NUM_RANGE_RE = re.compile(rf"(?<!\d){SIZE_NUM_ANY}\s*[-–/]\s*{SIZE_NUM_ANY}(?!\d)")
+_SIZE_NUM_ONLY_RE  = re.compile(rf"{SIZE_NUM_ANY}")
+_SIZE_PART_NUM_RE  = re.compile(r"\d+(?:,\d)?")
+
 def _strip_seasons_for_size_scan(text: str) -> str:
-    return re.sub(r"\b(?:NEW\s+)?(?:FW|SS)\d+(?:/\d+)?\b", " ", text, flags=re.I)
+    return _SEASON_ANY_RE.sub(" ", text)
 
 def _strip_discounts_and_prices(text: str) -> str:
-    text = re.sub(r"[–—\-−]\s?\d{1,2}\s?%", " ", text)
-    text = re.sub(_PRICE_TOKEN_RE, " ", text)
+    text = _DISCOUNT_STRIP_RE.sub(" ", text)
+    text = _PRICE_TOKEN_RE.sub(" ", text)
     return text
 
 def extract_sizes_anywhere(text: str) -> str:
     work = _strip_seasons_for_size_scan(text)
     work = _strip_discounts_and_prices(work)
 
-    ranges_dash  = re.findall(rf"(?<!\d)({SIZE_NUM_ANY})\s*[-–—]\s*({SIZE_NUM_ANY})(?!\d)", work)
-    ranges_slash = re.findall(rf"(?<!\d)({SIZE_NUM_ANY})\s*/\s*({SIZE_NUM_ANY})(?!\d)", work)
+    ranges_dash  = _SIZE_RANGE_DASH_RE.findall(work)
+    ranges_slash = _SIZE_RANGE_SLASH_RE.findall(work)
 
-    singles_num   = re.findall(rf"(?<!\d)({SIZE_NUM_ANY})(?!\d)", work)
-    singles_alpha = re.findall(rf"\b({SIZE_ALPHA})\b", work, flags=re.I)
+    singles_num   = _SIZE_NUM_RE.findall(work)
+    singles_alpha = _SIZE_ALPHA_RE.findall(work)
 
     parts: List[str] = []
     used = set()
@@ -444,7 +1948,7 @@ def extract_sizes_anywhere(text: str) -> str:
     evidence_of_ranges = bool(ranges_dash or ranges_slash)
     has_alpha = bool(singles_alpha)
     if not evidence_of_ranges and not has_alpha:
-        only_nums = [p for p in parts if re.fullmatch(r"\d+(?:,\d)?", p)]
+        only_nums = [p for p in parts if _SIZE_PART_NUM_RE.fullmatch(p)]
         if len(only_nums) == 1:
             val = only_nums[0].replace(",", ".")
             try:
@@ -461,10 +1965,14 @@ def extract_sizes_anywhere(text: str) -> str:
     return ", ".join(parts)
 
 # --- УНИВЕРСАЛЬНЫЙ ПАРСЕР ДЕНЕГ ---
+_NOT_MONEY_CHARS_RE = re.compile(r"[^\d.,]")
+_COMMA_CENTS_RE = re.compile(r",\d{1,2}$")
+_DOT_CENTS_RE = re.compile(r"\.\d{1,2}$")
+
 def parse_money_token(token: Optional[str]) -> Optional[float]:
     if not token:
         return None
-    s = re.sub(r"[^\d.,]", "", token)
+    s = _NOT_MONEY_CHARS_RE.sub("", token)
     if not s:
         return None
     if "," in s and "." in s:
@@ -478,7 +1986,7 @@ def parse_money_token(token: Optional[str]) -> Optional[float]:
         except ValueError:
             return None
     if "," in s and "." not in s:
-        if s.count(",") == 1 and re.search(r",\d{1,2}$", s):
+        if s.count(",") == 1 and _COMMA_CENTS_RE.search(s):
             s = s.replace(",", ".")
             try:
                 return float(s)
@@ -490,7 +1998,7 @@ def parse_money_token(token: Optional[str]) -> Optional[float]:
         except ValueError:
             return None
     if "." in s and "," not in s:
-        if s.count(".") == 1 and re.search(r"\.\d{1,2}$", s):
+        if s.count(".") == 1 and _DOT_CENTS_RE.search(s):
             try:
                 return float(s)
             except ValueError:
@@ -515,10 +2023,7 @@ PRICE_DISCOUNT_RE = re.compile(
     re.IGNORECASE | re.VERBOSE | re.S
 )
 
-def parse_price_discount(text: str) -> Tuple[Optional[float], Optional[int]]:
-    if not text:
-        return (None, None)
-    m = PRICE_DISCOUNT_RE.search(text)
+def _pair_from_match(m: Optional[re.Match]) -> Tuple[Optional[float], Optional[int]]:
     if not m:
         return (None, None)
     price = parse_money_token(m.group("price"))
@@ -529,10 +2034,15 @@ def parse_price_discount(text: str) -> Tuple[Optional[float], Optional[int]]:
         return (None, None)
     return (price, disc)
 
+def parse_price_discount(text: str) -> Tuple[Optional[float], Optional[int]]:
+    if not text:
+        return (None, None)
+    return _pair_from_match(PRICE_DISCOUNT_RE.search(text))
+
 # --- НОРМАЛИЗАЦИЯ «1.150 -> 1150», «2.990 -> 2990» ---
 _THOUSANDS_DOT_RE = re.compile(r'(?<!\d)(\d{1,3})\.(\d{3})(?!\d)')
 def normalize_thousands(text: str) -> str:
-    return _THOUSANDS_DOT_RE.sub(r"\1\2", text)
+    return _THOUSANDS_DOT_RE.sub(lambda m: m[1] + m[2], text)  # функция быстрее шаблона r"\1\2"
 
 # --- Блок «Размеры: ...» ---
 SIZES_BLOCK_RE = re.compile(r"Размеры:\s*(?P<body>.+?)(?:\n\s*\n|#|$)", re.I | re.S)
@@ -550,38 +2060,46 @@ def parse_sizes_block(text: str) -> str:
             seen.add(v); out.append(v)
     return ", ".join(out)
 
+_PRICE_EUR_WORD_RE = re.compile(r"\d{2,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?\s*(€|eur|euro)", re.I)
+
 def _is_price_line(l: str) -> bool:
-    return bool(PRICE_DISCOUNT_RE.search(l) or re.search(r"\d{2,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?\s*(€|eur|euro)", l, flags=re.I))
+    # два отдельных поиска быстрее одного по объединённому шаблону
+    return bool(PRICE_DISCOUNT_RE.search(l) or _PRICE_EUR_WORD_RE.search(l))
 
-def pick_sizes_line(lines: List[str]) -> str:
-    for line in lines:
+def pick_sizes_line(lines: List[str], price_flags: Optional[List[Optional[bool]]] = None) -> str:
+    # price_flags[i] — кэш _is_price_line(lines[i]) (None — ещё не считали); каждая строка проверяется один раз
+    if price_flags is None:
+        price_flags = [None] * len(lines)
+
+    def is_price(i: int) -> bool:
+        f = price_flags[i]
+        if f is None:
+            f = price_flags[i] = _is_price_line(lines[i].strip())
+        return f
+
+    for i, line in enumerate(lines):
         l = line.strip()
-        if not l or _is_price_line(l):
+        if not l or is_price(i):
             continue
-        if re.search(rf"\b({SIZE_ALPHA})\b", l, flags=re.I):
-            return l
-        if re.search(rf"(?<!\d){SIZE_NUM_ANY}(?:\s*(?:[,/]\s*{SIZE_NUM_ANY}))+?(?!\d)", l):
-            return l
-        if re.search(rf"(?<!\d){SIZE_NUM_ANY}\s*[-–/]\s*{SIZE_NUM_ANY}(?!\d)", l):
+        if _SIZE_ALPHA_RE.search(l) or _SIZE_NUM_LIST_RE.search(l) or _SIZE_NUM_RANGE_RE.search(l):
             return l
+    last = len(lines) - 1
     for i, line in enumerate(lines):
         l = line.strip()
-        if not l or _is_price_line(l):
+        if not l or is_price(i):
             continue
-        if re.fullmatch(rf"{SIZE_NUM_ANY}", l):
-            prev_is_price = (i > 0 and _is_price_line(lines[i-1].strip()))
-            next_is_price = (i+1 < len(lines) and _is_price_line(lines[i+1].strip()))
-            if prev_is_price or next_is_price:
+        if _SIZE_NUM_ONLY_RE.fullmatch(l):
+            if (i > 0 and is_price(i - 1)) or (i < last and is_price(i + 1)):
                 continue
             return l
     return ""
 
 def pick_season_line(lines: List[str]) -> str:
     for line in lines:
-        if re.search(r"\bNEW\s+(?:FW|SS)\d+(?:/\d+)?\b", line, flags=re.I):
+        if _SEASON_NEW_RE.search(line):
             return line.strip()
     for line in lines:
-        if re.search(r"\b(?:FW|SS)\d+(?:/\d+)?\b", line, flags=re.I):
+        if _SEASON_RE.search(line):
             return line.strip()
     return ""
 
@@ -595,23 +2113,48 @@ PRICE_TOKEN_OR_PAIR_RE = re.compile(
     re.IGNORECASE | re.VERBOSE | re.S,
 )
 
-def parse_input(raw_text: str) -> Dict[str, Optional[str]]:
-    raw_text = normalize_thousands(raw_text)
-    text = cleanup_text_basic(raw_text)
-    lines = [l.strip() for l in text.splitlines() if l.strip()]
+# --- Токенизатор подписи ---
+_EUR_PRICE_RE = re.compile(r"(\d{1,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\s*€")
+_DISCOUNT_RE  = re.compile(r"[–—\-−]\s*(\d{1,2})\s*%")
+_RETAIL_RE    = re.compile(r"Retail\s*price\s*(\d{1,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)", re.I)
+
+@dataclass
+class CaptionScan:
+    """Результат одного прохода по подписи: первые вхождения денежных токенов
+    (с позициями в text) и строки; price_flags — признак «ценовая строка», заполняется по мере надобности."""
+    text: str
+    lines: List[str]
+    price_flags: List[Optional[bool]]
+    pair: Optional[re.Match]       # «650€ -35%»: группы price, discount
+    price: Optional[re.Match]      # «650€»
+    discount: Optional[re.Match]   # «-35%»
+    retail: Optional[re.Match]     # «Retail price 1150»
+
+def scan_caption(raw_text: str) -> CaptionScan:
+    text = cleanup_text_basic(normalize_thousands(raw_text))
+    lines = [l for l in (r.strip() for r in text.splitlines()) if l]
+    return CaptionScan(
+        text=text,
+        lines=lines,
+        price_flags=[None] * len(lines),
+        pair=PRICE_DISCOUNT_RE.search(text),
+        price=_EUR_PRICE_RE.search(text),
+        discount=_DISCOUNT_RE.search(text),
+        retail=_RETAIL_RE.search(text),
+    )
 
-    price_uni, discount_uni = parse_price_discount(text)
+def parse_input(raw_text: str) -> Dict[str, Optional[str]]:
+    sc = scan_caption(raw_text)
+    text = sc.text
 
-    price_m    = re.search(r"(\d{1,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)\s*€", text)
-    discount_m = re.search(r"[–—\-−]\s*(\d{1,2})\s*%", text)
-    retail_m   = re.search(r"Retail\s*price\s*(\d{1,6}(?:[.,]\d{3})*(?:[.,]\d{1,2})?)", text, flags=re.I)
+    price_uni, discount_uni = _pair_from_match(sc.pair)
 
-    price    = price_uni if price_uni is not None else (parse_number_token(price_m.group(1)) if price_m else None)
-    discount = discount_uni if discount_uni is not None else (int(discount_m.group(1)) if discount_m else 0)
-    retail   = parse_number_token(retail_m.group(1)) if retail_m else (price if price is not None else 0.0)
+    price    = price_uni if price_uni is not None else (parse_number_token(sc.price.group(1)) if sc.price else None)
+    discount = discount_uni if discount_uni is not None else (int(sc.discount.group(1)) if sc.discount else 0)
+    retail   = parse_number_token(sc.retail.group(1)) if sc.retail else (price if price is not None else 0.0)
 
-    sizes_line  = parse_sizes_block(text) or pick_sizes_line(lines) or extract_sizes_anywhere(text)
-    season_line = pick_season_line(lines)
+    sizes_line  = parse_sizes_block(text) or pick_sizes_line(sc.lines, sc.price_flags) or extract_sizes_anywhere(text)
+    season_line = pick_season_line(sc.lines)
 
     return {
         "price": price,
@@ -642,11 +2185,12 @@ def _split_by_price_lines(caption: str) -> List[str]:
         saw_price_in_cur = False
 
     for r in rows:
+        is_price = _is_price_line(r)
         # если пришла новая ценовая строка, а в текущем блоке уже была цена — закрываем текущий блок
-        if _is_price_line(r) and saw_price_in_cur:
+        if is_price and saw_price_in_cur:
             flush()
         cur.append(r)
-        if _is_price_line(r):
+        if is_price:
             saw_price_in_cur = True
 
     # финальный сброс
@@ -663,12 +2207,53 @@ def _split_positions(caption: str) -> List[str]:
     good = [b for b in blocks if PRICE_TOKEN_OR_PAIR_RE.search(b)]
     return good if len(good) >= 2 else []
 
+# --- Кэш разбора: одни и те же подписи приходят многократно (репосты, склейка альбома с текстом) ---
+_parse_cache = TTLCache(PARSE_CACHE_MAX)
+_card_cache = TTLCache(CARD_CACHE_MAX)
+_CACHE_MISS = object()
+
+def _caption_key(caption: str) -> bytes:
+    # пробелы по краям на результат не влияют — не плодим из-за них записи
+    return hashlib.blake2b((caption or "").strip().encode("utf-8"), digest_size=16).digest()
+
+def parse_input_cached(raw_text: str) -> Dict[str, Optional[str]]:
+    """parse_input с LRU-кэшем; результат общий — не изменять."""
+    key = _caption_key(raw_text)
+    data = _parse_cache.get(key, _CACHE_MISS)
+    if data is _CACHE_MISS:
+        data = parse_input(raw_text)
+        _parse_cache.put(key, data)
+    return data
+
+def _mode_key_for(user_id: int) -> str:
+    mode_key = active_mode.get(user_id, "sale")
+    return mode_key if mode_key in MODES else "sale"
+
+def calc_for(user_id: int, mode_key: str) -> Callable[[float, int], int]:
+    formula = mode_formulas.get((user_id, mode_key))
+    return compile_formula(formula) if formula else MODES[mode_key]["calc"]
+
+def _pricing_key_for(user_id: int) -> str:
+    # ключ кэша карточек: режим, а при своей формуле — режим и формула
+    mode_key = _mode_key_for(user_id)
+    formula = mode_formulas.get((user_id, mode_key))
+    return f"{mode_key}|{formula}" if formula else mode_key
+
+def invalidate_cards_for_mode(mode_key: str):
+    for key in _card_cache.keys():
+        if key[0] == mode_key:
+            _card_cache.pop(key)
+
+def parse_cache_stats_line() -> str:
+    return f"Разбор подписей: {_parse_cache.stats_line()}\nКарточки: {_card_cache.stats_line()}"
+
 def build_result_text_for_block(user_id: int, text_block: str) -> str:
-    data = parse_input(text_block)
+    data = parse_input_cached(text_block)
     price = data.get("price")
-    mode = MODES.get(active_mode.get(user_id, "sale"), MODES["sale"])
-    calc_fn, tpl_fn = mode["calc"], mode["template"]
+    mode_key = _mode_key_for(user_id)
+    calc_fn, tpl_fn = calc_for(user_id, mode_key), MODES[mode_key]["template"]
     if price is None:
+        M_PARSE_FAIL.inc(kind="block")
         hint = "⚠️ Не нашла цену. Пример: 650€ -35% или 1360-20%"
         sizes = (data.get("sizes_line") or "").strip()
         season = (data.get("season_line") or "").strip()
@@ -765,7 +2350,12 @@ async def set_mode(msg: Message):
     cmd = msg.text.lstrip("/").split()[0]
     if not is_admin(user_id):
         return await msg.answer("⛔ Только для админов.")
+    prev = active_mode.get(user_id, "sale")
     active_mode[user_id] = cmd
+    state.put("mode", user_id, cmd)
+    if prev != cmd and prev not in active_mode.values():
+        # старым режимом больше никто не пользуется — его карточки не понадобятся
+        invalidate_cards_for_mode(prev)
     await msg.answer(f"✅ Режим <b>{MODES[cmd]['label']}</b> активирован.")
 
 @router.message(Command("mode"))
@@ -776,6 +2366,44 @@ async def show_mode(msg: Message):
     ocr_state = "ON" if is_ocr_enabled_for(user_id) else "OFF"
     await msg.answer(f"Текущий режим: <b>{label}</b>\nOCR в альбомах: <b>{ocr_state}</b>")
 
+FORMULA_HELP = (
+    "Формат: <code>-%; ≤250 +55; ≤400 +70; +10% +30</code>\n"
+    "-% — скидка из поста (в начале), ≤N/&lt;N — ступень, без условия в конце — «иначе».\n"
+    "Шаги: +N, -N, +N%, -N%, ×N. <code>/formula off</code> — вернуть формулу режима."
+)
+
+@router.message(Command("formula"))
+async def set_formula(msg: Message):
+    """/formula — показать; /formula <правило> — задать для текущего режима; /formula off — сбросить."""
+    user_id = msg.from_user.id
+    if not is_admin(user_id):
+        return await msg.answer("⛔ Только для админов.")
+    mode_key = _mode_key_for(user_id)
+    label = MODES[mode_key]["label"]
+    arg = ((msg.text or "").split(maxsplit=1)[1:] or [""])[0].strip()
+    current = mode_formulas.get((user_id, mode_key))
+    if not arg:
+        shown = current or FORMULA_DEFAULTS.get(MODES[mode_key]["calc"], "—")
+        origin = "своя" if current else "по умолчанию"
+        return await msg.answer(f"Формула режима <b>{label}</b> ({origin}):\n<code>{html.escape(shown)}</code>\n\n{FORMULA_HELP}")
+
+    old_key = _pricing_key_for(user_id)
+    if arg.lower() in ("off", "reset", "сброс"):
+        mode_formulas.pop((user_id, mode_key), None)
+        state.delete("formula", f"{user_id}|{mode_key}")
+        invalidate_cards_for_mode(old_key)
+        return await msg.answer(f"✅ Режим <b>{label}</b>: формула по умолчанию.")
+    try:
+        calc = compile_formula(arg)
+    except ValueError as e:
+        return await msg.answer(f"⚠️ {html.escape(str(e))}\n{FORMULA_HELP}")
+    sample = calc(650.0, 35)  # до сохранения: сломанное правило не должно попасть в state
+    mode_formulas[(user_id, mode_key)] = calc.formula
+    state.put("formula", f"{user_id}|{mode_key}", calc.formula)
+    invalidate_cards_for_mode(old_key)
+    await msg.answer(f"✅ Режим <b>{label}</b>: <code>{html.escape(calc.formula)}</code>\n"
+                     f"Пример: 650€ -35% → {sample}€")
+
 @router.message(Command("help"))
 async def show_help(msg: Message):
     await msg.answer(
@@ -783,25 +2411,101 @@ async def show_help(msg: Message):
         "• /lux — OCR выключен, /luxocr — OCR включен.\n"
         "• Формула: ≤250€ +55€; 251–400€ +70€; >400€ → +10% и +30€. Всё округляем вверх.\n"
         "• Альбом без подписи публикуется сразу.\n"
-        "• /mode — показать текущий режим и состояние OCR."
+        "• /mode — показать текущий режим и состояние OCR.\n"
+        "• /formula — своя формула цены для текущего режима."
     )
 
+@router.message(Command("ocrstats"))
+async def show_ocr_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    await msg.answer(ocr_cache_stats_line() + "\n" + precheck_stats_line())
+
+@router.message(Command("cachestats"))
+async def show_cache_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    await msg.answer(parse_cache_stats_line())
+
+@router.message(Command("queuestats"))
+async def show_queue_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    await msg.answer(lanes_stats_line() + "\n" + reorder_stats_line() + "\n" + outboxes_stats_line()
+                     + "\n" + timers.stats_line() + "\n" + album_settle_stats_line())
+
+@router.message(Command("memstats"))
+async def show_mem_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    for st in _STORES:
+        st.sweep()
+    await msg.answer(stores_stats_line())
+
+@router.message(Command("stats"))
+async def show_stats(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    await msg.answer(metrics_stats_line())
+
+_profiling = False
+
+@router.message(Command("profile"))
+async def run_profile(msg: Message):
+    """/profile [секунд] — cProfile по event loop на N секунд, в ответ — самые «горячие» функции."""
+    global _profiling
+    if not is_admin(msg.from_user.id):
+        return await msg.answer("⛔ Только для админов.")
+    if _profiling:
+        return await msg.answer("Профилирование уже идёт.")
+    arg = (msg.text or "").split()[1:2]
+    seconds = min(PROFILE_MAX_S, max(1, int(arg[0]))) if arg and arg[0].isdigit() else 10
+    _profiling = True
+    prof = cProfile.Profile()
+    try:
+        await msg.answer(f"Профилирую {seconds} с…")
+        prof.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+        _profiling = False
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).strip_dirs().sort_stats("tottime").print_stats(15)
+    # шапку pstats пропускаем — оставляем таблицу функций
+    report = out.getvalue()
+    report = report[report.find("ncalls"):] if "ncalls" in report else report
+    await msg.answer(f"<pre>{html.escape(report[:3800], quote=False)}</pre>")
+
 @router.message(Command("ping"))
 async def ping(msg: Message):
     await msg.answer("pong")
 
 # ====== СБОРКА ПОДПИСИ ======
 def build_result_text(user_id: int, caption: str) -> Optional[str]:
+    t0 = time.perf_counter()
+    key = (_pricing_key_for(user_id), _caption_key(caption))
+    result = _card_cache.get(key, _CACHE_MISS)
+    if result is _CACHE_MISS:
+        result = _build_result_text_uncached(user_id, caption)
+        _card_cache.put(key, result)
+    M_PARSE.observe(time.perf_counter() - t0)
+    return result
+
+def no_price_caption(text: str) -> str:
+    M_PARSE_FAIL.inc(kind="caption")
+    return f"⚠️ Не нашла цену в тексте. Пример: 650€ -35% или 1360-20%\n\n{text}"
+
+def _build_result_text_uncached(user_id: int, caption: str) -> Optional[str]:
     multi = build_result_text_multi(user_id, caption)
     if multi:
         return multi
 
-    data = parse_input(caption)
+    data = parse_input_cached(caption)
     price = data.get("price")
     if price is None:
         return None
-    mode = MODES.get(active_mode.get(user_id, "sale"), MODES["sale"])
-    calc_fn, tpl_fn, _label = mode["calc"], mode["template"], mode["label"]
+    mode_key = _mode_key_for(user_id)
+    calc_fn, tpl_fn = calc_for(user_id, mode_key), MODES[mode_key]["template"]
     final_price = calc_fn(float(price), int(data.get("discount", 0)))
     return tpl_fn(
         final_price=final_price,
@@ -812,29 +2516,90 @@ def build_result_text(user_id: int, caption: str) -> Optional[str]:
     )
 
 # ====== ХЕЛПЕРЫ ======
-async def _remember_media_for_text(chat_id: int, user_id: int, items: List[Dict[str, Any]], first_mid: int, caption: str = ""):
-    last_media[chat_id] = {
+async def _remember_media_for_text(chat_id: int, user_id: int, items: List[MediaItem], first_mid: int, caption: str = ""):
+    bucket = last_media[chat_id] = {
         "ts": datetime.now(),
         "items": items,
         "caption": caption or "",
         "user_id": user_id,
         "first_mid": first_mid,
     }
+    persist_last_media(chat_id)
+    _arm_media_window(chat_id, bucket)
+
+def _arm_media_window(chat_id: int, bucket: Dict[str, Any]):
+    # текст склеивается с медиа только в пределах ALBUM_WINDOW_SECONDS — после этого ждать нечего:
+    # публикуем как есть, чтобы «сирота» не держала порядок публикаций чата до истечения TTL хранилища
+    left = ALBUM_WINDOW_SECONDS - (datetime.now() - bucket["ts"]).total_seconds()
+    timers.schedule(("media", chat_id), left, lambda: _media_window_closed(chat_id, bucket))
+
+async def _media_window_closed(chat_id: int, bucket: Dict[str, Any]):
+    if last_media.get(chat_id) is bucket:
+        await _flush_pending_single_media(chat_id)
 
 # >>> NEW: принудительный флаш предыдущего одиночного медиа перед новым
 async def _flush_pending_single_media(chat_id: int):
     bucket = last_media.get(chat_id)
     if not bucket:
         return
-    items: List[Dict[str, Any]] = bucket.get("items") or []
+    items: List[MediaItem] = bucket.get("items") or []
     if not items:
         last_media.pop(chat_id, None)
+        persist_last_media(chat_id)
+        return
+    await _publish_pending_media(chat_id, bucket)
+    last_media.pop(chat_id, None)
+    persist_last_media(chat_id)
+
+async def _publish_pending_media(chat_id: int, bucket: Dict[str, Any]):
+    items: List[MediaItem] = bucket.get("items") or []
+    if not items:
         return
-    first_mid = bucket.get("first_mid") or min(it["mid"] for it in items)
+    first_mid = bucket.get("first_mid") or min(map(mid_of, items))
     user_id = bucket.get("user_id") or 0
     # Публикуем как есть, без подсказок
-    await publish_to_target(first_mid=first_mid, user_id=user_id, items=items, caption="")
-    last_media.pop(chat_id, None)
+    await publish_to_target(chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items, caption="")
+
+def _evict_last_media(chat_id: int, bucket: Dict[str, Any], reason: str):
+    persist_last_media(chat_id)
+    print(f"STORE last_media: chat {chat_id} flushed ({reason})")
+    asyncio.create_task(_publish_pending_media(chat_id, bucket))
+
+last_media.on_evict = _evict_last_media
+
+def _photo_sizes(msg: Message) -> Tuple[Tuple[str, int, int], ...]:
+    return tuple(sorted(((p.file_id, p.width, p.height) for p in (msg.photo or [])), key=lambda s: s[1] * s[2]))
+
+# ====== АДАПТИВНАЯ СБОРКА АЛЬБОМОВ ======
+_album_gaps: Dict[int, deque] = {}  # chat_id → последние интервалы между кадрами одного альбома (секунды)
+# альбомы, собранные недавно: если к ним пришёл ещё кадр — пауза была слишком короткой
+_recently_flushed_albums = TTLCache(2000, ttl_s=60)
+_album_settle_stats = {"albums": 0, "full": 0, "split": 0, "quiet_ms_total": 0.0}
+M_ALBUM_QUIET = histogram("album_quiet_seconds", "Пауза после последнего кадра до сборки альбома")
+M_ALBUM_SPLIT = counter("album_split_total", "Кадры, пришедшие после сборки своего альбома")
+
+def album_gap_observe(chat_id: int, gap_s: float):
+    gaps = _album_gaps.get(chat_id)
+    if gaps is None:
+        gaps = _album_gaps[chat_id] = deque(maxlen=200)
+    gaps.append(gap_s)
+
+def album_settle_s(chat_id: int) -> float:
+    max_s = ALBUM_SETTLE_MS / 1000
+    gaps = _album_gaps.get(chat_id)
+    if not ALBUM_SETTLE_ADAPTIVE or not gaps or len(gaps) < ALBUM_SETTLE_MIN_SAMPLES:
+        return max_s
+    ordered = sorted(gaps)
+    q = ordered[min(len(ordered) - 1, int(ALBUM_SETTLE_QUANTILE * len(ordered)))]
+    return min(max_s, max(ALBUM_SETTLE_MIN_MS / 1000, q * ALBUM_SETTLE_FACTOR))
+
+def album_settle_stats_line() -> str:
+    st = _album_settle_stats
+    avg = st["quiet_ms_total"] / st["albums"] if st["albums"] else 0.0
+    learned = sum(1 for g in _album_gaps.values() if len(g) >= ALBUM_SETTLE_MIN_SAMPLES)
+    return (f"Сборка альбомов: {st['albums']}, пауза после последнего кадра ср. {avg:.0f} ms "
+            f"(фиксированная была бы {ALBUM_SETTLE_MS} ms), сразу по {ALBUM_MAX_ITEMS} кадрам: {st['full']}, "
+            f"разорвано: {st['split']}, чатов с выученным интервалом: {learned}")
 
 # ====== ХЕНДЛЕРЫ ======
 @router.message(F.photo & (F.media_group_id == None))
@@ -842,7 +2607,8 @@ async def handle_single_photo(msg: Message):
     # Флашим то, что "ждало" текста, прежде чем принимать новый единичный кадр
     await _flush_pending_single_media(msg.chat.id)
 
-    item = {"kind": "photo", "fid": msg.photo[-1].file_id, "mid": msg.message_id, "cap": bool(msg.caption)}
+    item = MediaItem(MediaKind.PHOTO, msg.message_id, fid=msg.photo[-1].file_id, uid=msg.photo[-1].file_unique_id,
+                     cap=bool(msg.caption), sizes=_photo_sizes(msg))
     caption = (msg.caption or "").strip()
 
     if _attach_media_to_next_batch(msg.chat.id, [item], msg.from_user.id):
@@ -851,7 +2617,8 @@ async def handle_single_photo(msg: Message):
     if caption:
         result = build_result_text(msg.from_user.id, caption)
         if result:
-            await publish_to_target(first_mid=msg.message_id, user_id=msg.from_user.id, items=[item], caption=result)
+            await publish_to_target(chat_id=msg.chat.id, first_mid=msg.message_id, user_id=msg.from_user.id,
+                                    items=[item], caption=result)
             return
     await _remember_media_for_text(msg.chat.id, msg.from_user.id, [item], first_mid=msg.message_id, caption=caption)
     # (подсказку про «Добавь текст…» больше не отправляем)
@@ -861,7 +2628,8 @@ async def handle_single_video(msg: Message):
     # Флашим то, что "ждало" текста, прежде чем принимать новый единичный кадр
     await _flush_pending_single_media(msg.chat.id)
 
-    item = {"kind": "video", "fid": msg.video.file_id, "mid": msg.message_id, "cap": bool(msg.caption)}
+    item = MediaItem(MediaKind.VIDEO, msg.message_id, fid=msg.video.file_id, uid=msg.video.file_unique_id,
+                     cap=bool(msg.caption))
     caption = (msg.caption or "").strip()
 
     if _attach_media_to_next_batch(msg.chat.id, [item], msg.from_user.id):
@@ -870,7 +2638,8 @@ async def handle_single_video(msg: Message):
     if caption:
         result = build_result_text(msg.from_user.id, caption)
         if result:
-            await publish_to_target(first_mid=msg.message_id, user_id=msg.from_user.id, items=[item], caption=result)
+            await publish_to_target(chat_id=msg.chat.id, first_mid=msg.message_id, user_id=msg.from_user.id,
+                                    items=[item], caption=result)
             return
     await _remember_media_for_text(msg.chat.id, msg.from_user.id, [item], first_mid=msg.message_id, caption=caption)
     # (подсказку про «Добавь текст…» больше не отправляем)
@@ -881,61 +2650,113 @@ async def handle_album_any(msg: Message):
     key = (chat_id, mgid)
 
     if msg.photo:
-        fid = msg.photo[-1].file_id
-        kind = "photo"
+        fid, uid = msg.photo[-1].file_id, msg.photo[-1].file_unique_id
+        kind = MediaKind.PHOTO
     elif msg.video:
-        fid = msg.video.file_id
-        kind = "video"
+        fid, uid = msg.video.file_id, msg.video.file_unique_id
+        kind = MediaKind.VIDEO
     else:
         return
 
     cap_text = (msg.caption or "").strip()
     has_cap = bool(cap_text)
 
+    now = time.monotonic()
     buf = album_buffers.get(key)
     if not buf:
-        buf = {"items": [], "caption": "", "task": None, "user_id": msg.from_user.id, "first_mid": msg.message_id}
+        flushed_at = _recently_flushed_albums.get(key)
+        if flushed_at is not None:
+            _recently_flushed_albums.pop(key)
+            # хвост уже собранного альбома: учитываем настоящий интервал, чтобы пауза выросла
+            _album_settle_stats["split"] += 1
+            M_ALBUM_SPLIT.inc()
+            album_gap_observe(chat_id, now - flushed_at)
+        buf = {"items": [], "caption": "", "user_id": msg.from_user.id, "first_mid": msg.message_id,
+               "ocr_sem": asyncio.Semaphore(max(1, OCR_ALBUM_CONCURRENCY)), "t0": now,
+               "trace": _trace_id.get()}
         album_buffers[key] = buf
-
-    buf["items"].append({"kind": kind, "fid": fid, "mid": msg.message_id, "cap": has_cap})
+    elif "t_last" in buf:
+        album_gap_observe(chat_id, now - buf["t_last"])
+    buf["t_last"] = now
+
+    item = MediaItem(kind, msg.message_id, fid=fid, uid=uid, cap=has_cap)
+    if kind is MediaKind.PHOTO:
+        item.sizes = _photo_sizes(msg)
+        if is_ocr_enabled_for(buf["user_id"]):
+            _start_speculative_ocr(item, buf["ocr_sem"])
+    # части альбома могут прийти не по порядку — держим items упорядоченными по mid сразу
+    bisect.insort(buf["items"], item, key=mid_of)
+    album_buffers.touch(key)
+    album_index_update(key, buf)
     if has_cap and not buf["caption"]:
         buf["caption"] = cap_text
-
-    if buf["task"]:
-        buf["task"].cancel()
-
-    async def _flush_album():
-        await asyncio.sleep(ALBUM_SETTLE_MS / 1000)
-        data = album_buffers.pop(key, None)
-        if not data:
+    persist_album(key)
+
+    if not buf["caption"]:
+        # без подписи ждём полный ALBUM_SETTLE_MS: следом может прийти текст к этому альбому
+        timers.schedule(("album", key), ALBUM_SETTLE_MS / 1000, lambda: _flush_album(key))
+    elif len(buf["items"]) >= ALBUM_MAX_ITEMS:
+        # больше кадров не будет — собираем сразу
+        _album_settle_stats["full"] += 1
+        timers.schedule(("album", key), 0, lambda: _flush_album(key))
+    else:
+        # каждый новый кадр отодвигает сборку альбома
+        timers.schedule(("album", key), album_settle_s(chat_id), lambda: _flush_album(key))
+
+async def _flush_album(key: Tuple[int, str]):
+    data = album_buffers.pop(key, None)
+    album_index_remove(key, data)
+    persist_album(key)
+    if data:
+        await _publish_album(key, data)
+
+def _evict_album(key: Tuple[int, str], data: Dict[str, Any], reason: str):
+    # буфер без срабатывания таймера (или вытесненный) — собираем как есть
+    timers.cancel(("album", key))
+    album_index_remove(key, data)
+    persist_album(key)
+    print(f"STORE album_buffers: {key} flushed ({reason}), {len(data.get('items') or [])} items")
+    asyncio.create_task(_publish_album(key, data))
+
+album_buffers.on_evict = _evict_album
+
+async def _publish_album(key: Tuple[int, str], data: Dict[str, Any]):
+    chat_id = key[0]
+    # задача создана последним кадром, но альбом ведём под trace id первого
+    _trace_id.set(data.get("trace") or _trace_id.get())
+    if "t_last" in data:
+        quiet = time.monotonic() - data["t_last"]
+        M_ALBUM_QUIET.observe(quiet)
+        _album_settle_stats["albums"] += 1
+        _album_settle_stats["quiet_ms_total"] += quiet * 1000
+        _recently_flushed_albums.put(key, data["t_last"])
+    if "t0" in data:  # у восстановленных после рестарта буферов отметки нет
+        M_ALBUM_SETTLE.observe(time.monotonic() - data["t0"])
+        trace_event("album.flush", chat=chat_id, items=len(data["items"]),
+                    settle_ms=round((time.monotonic() - data["t0"]) * 1000, 2))
+
+    items: List[MediaItem] = data["items"]
+    caption = data["caption"]
+    user_id = data["user_id"]
+    first_mid = data["first_mid"]
+
+    if not caption:
+        if _attach_media_to_next_batch(chat_id, items, user_id):
             return
 
-        items: List[Dict[str, Any]] = data["items"]
-        caption = data["caption"]
-        user_id = data["user_id"]
-        first_mid = data["first_mid"]
-
-        items.sort(key=lambda x: x["mid"])
-
-        if not caption:
-            if _attach_media_to_next_batch(chat_id, items, user_id):
-                return
-
-        if caption:
-            result = build_result_text(user_id, caption)
-            if result:
-                await publish_to_target(first_mid=first_mid, user_id=user_id, items=items, caption=result)
-                return
-            await publish_to_target(
-                first_mid=first_mid, user_id=user_id, items=items,
-                caption=f"⚠️ Не нашла цену в тексте. Пример: 650€ -35% или 1360-20%\n\n{caption}"
-            )
+    if caption:
+        result = build_result_text(user_id, caption)
+        if result:
+            await publish_to_target(chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items, caption=result)
             return
-
-        await publish_to_target(first_mid=first_mid, user_id=user_id, items=items, caption="")
+        await publish_to_target(
+            chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items,
+            caption=no_price_caption(caption)
+        )
         return
 
-    buf["task"] = asyncio.create_task(_flush_album())
+    await publish_to_target(chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items, caption="")
+    return
 
 @router.message(F.text)
 async def handle_text(msg: Message):
@@ -956,6 +2777,8 @@ async def handle_text(msg: Message):
         q = _get_q(chat_id)
         rec = BatchRec(text_msg=msg, user_id=msg.from_user.id)
         q.append(rec)
+        batches.touch(chat_id)
+        persist_batches(chat_id)
         _arm_batch_timer(chat_id, rec)
         return
 
@@ -968,64 +2791,464 @@ async def handle_text(msg: Message):
         raw_text += (msg.text or "")
 
         result = build_result_text(user_id, raw_text)
-        items: List[Dict[str, Any]] = bucket.get("items") or []
-        first_mid = bucket.get("first_mid") or (min(it["mid"] for it in items) if items else msg.message_id)
+        items: List[MediaItem] = bucket.get("items") or []
+        first_mid = bucket.get("first_mid") or (min(map(mid_of, items)) if items else msg.message_id)
 
         if result:
-            await publish_to_target(first_mid=first_mid, user_id=user_id, items=items, caption=result)
+            await publish_to_target(chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items, caption=result)
         else:
             await publish_to_target(
-                first_mid=first_mid, user_id=user_id, items=items,
-                caption=f"⚠️ Не нашла цену в тексте. Пример: 650€ -35% или 1360-20%\n\n{msg.text}"
+                chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items,
+                caption=no_price_caption(msg.text)
             )
 
         del last_media[chat_id]
+        persist_last_media(chat_id)
         return
 
-    cand = [(k, v) for (k, v) in album_buffers.items() if k[0] == chat_id and v.get("items")]
-    if cand:
-        def last_mid(buf): return max(it["mid"] for it in buf["items"])
-        cand.sort(key=lambda kv: last_mid(kv[1]))
-        eligible = [kv for kv in cand if last_mid(kv[1]) <= msg.message_id]
-        key, data = (eligible[-1] if eligible else cand[-1])
-
-        items: List[Dict[str, Any]] = data["items"]
+    key = album_for_text(chat_id, msg.message_id)
+    if key:
+        data = album_buffers[key]
+        items: List[MediaItem] = data["items"]
         caption = (data.get("caption") or "")
         if caption:
             caption += "\n"
         caption += (msg.text or "")
 
-        items.sort(key=lambda x: x["mid"])
 
         user_id = data.get("user_id") or msg.from_user.id
-        first_mid = data.get("first_mid", items[0]["mid"] if items else msg.message_id)
+        first_mid = data.get("first_mid", items[0].mid if items else msg.message_id)
         result = build_result_text(user_id, caption)
 
-        if data.get("task"):
-            data["task"].cancel()
+        timers.cancel(("album", key))
         album_buffers.pop(key, None)
+        album_index_remove(key, data)
+        persist_album(key)
 
         if result:
-            await publish_to_target(first_mid=first_mid, user_id=user_id, items=items, caption=result)
+            await publish_to_target(chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items, caption=result)
         else:
             await publish_to_target(
-                first_mid=first_mid, user_id=user_id, items=items,
-                caption=f"⚠️ Не нашла цену в тексте. Пример: 650€ -35% или 1360-20%\n\n{msg.text}"
+                chat_id=chat_id, first_mid=first_mid, user_id=user_id, items=items,
+                caption=no_price_caption(msg.text)
             )
         return
 
     if not has_price and not has_custom:
-        text_item = [{"kind": "text", "fid": "", "mid": msg.message_id, "cap": True}]
-        await publish_to_target(first_mid=msg.message_id, user_id=msg.from_user.id, items=text_item, caption=txt)
+        text_item = [MediaItem(MediaKind.TEXT, msg.message_id, cap=True)]
+        await publish_to_target(chat_id=chat_id, first_mid=msg.message_id, user_id=msg.from_user.id,
+                                items=text_item, caption=txt)
         return
 
     return
 
+# ====== ИМПОРТ ПРАЙСОВ ======
+# /import в подписи к документу: CSV/XLSX/TXT читаются построчно, цены пересчитываются
+# одним векторным проходом (calc_many), в ответ — тот же прайс с колонкой итоговой цены.
+try:
+    import openpyxl
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    openpyxl = None
+    OPENPYXL_AVAILABLE = False
+
+_IMPORT_RETAIL_COLS = ("retail",)
+_IMPORT_SIZES_COLS = ("size", "taglia", "taglie", "größe", "размер")
+_IMPORT_SEASON_COLS = ("season", "stagione", "сезон")
+_IMPORT_DISCOUNT_COLS = ("discount", "sconto", "rabatt", "скидка", "%")
+_IMPORT_PRICE_COLS = ("price", "prezzo", "preis", "prix", "цена", "eur", "€")
+_IMPORT_PUBLISH_ARGS = ("publish", "опубликовать")
+_NUMBER_CELL_RE = re.compile(r"[\d\s.,€%\-−]+")
+
+@dataclass(slots=True)
+class ImportRow:
+    cells: List[str]
+    price: Optional[float]
+    discount: int
+    retail: float
+    sizes_line: str
+    season_line: str
+
+def _import_format(filename: str) -> Optional[str]:
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        return "xlsx" if OPENPYXL_AVAILABLE else None
+    if ext in (".csv", ".tsv"):
+        return "csv"
+    if ext in (".txt", ""):
+        return "txt"
+    return None
+
+def _cell_str(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+def _iter_import_rows(data: bytes, fmt: str) -> Iterator[List[str]]:
+    if fmt == "xlsx":
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            for row in wb.active.iter_rows(values_only=True):
+                yield [_cell_str(v) for v in row]
+        finally:
+            wb.close()
+        return
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", errors="replace", newline="")
+    if fmt == "csv":
+        sample = data[:65536].decode("utf-8-sig", errors="replace")
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        for row in csv.reader(stream, dialect):
+            yield [c.strip() for c in row]
+        return
+    # TXT: позиции через пустую строку (или несколько позиций подряд — режем как подпись)
+    block: List[str] = []
+    for line in itertools.chain(stream, [""]):
+        if line.strip():
+            block.append(line.rstrip("\r\n"))
+            continue
+        if block:
+            text = "\n".join(block)
+            for b in (_split_positions(text) or [text]):
+                yield [b]
+            block = []
+
+def _import_columns(header: List[str]) -> Dict[str, int]:
+    cols: Dict[str, int] = {}
+    for idx, cell in enumerate(header):
+        low = cell.lower()
+        if not low or _NUMBER_CELL_RE.fullmatch(low):
+            continue
+        if any(k in low for k in _IMPORT_RETAIL_COLS):
+            cols.setdefault("retail", idx)
+        elif any(k in low for k in _IMPORT_SIZES_COLS):
+            cols.setdefault("sizes", idx)
+        elif any(k in low for k in _IMPORT_SEASON_COLS):
+            cols.setdefault("season", idx)
+        elif any(k in low for k in _IMPORT_DISCOUNT_COLS):
+            cols.setdefault("discount", idx)
+        elif any(k in low for k in _IMPORT_PRICE_COLS):
+            cols.setdefault("price", idx)
+    return cols if "price" in cols else {}
+
+def _discount_cell(cell: str) -> int:
+    d = parse_number_token(cell)
+    if d is None:
+        return 0
+    if 0 < d < 1:  # в XLSX процентный формат приходит долей: 0.35
+        d *= 100
+    return int(round(d))
+
+def _import_row(cells: List[str], cols: Dict[str, int], sizes_memo: Dict[str, str]) -> ImportRow:
+    if not cols:
+        data = parse_input("\n".join(c for c in cells if c))
+        price = data.get("price")
+        return ImportRow(cells, price, int(data.get("discount") or 0), float(data.get("retail") or 0.0),
+                         data.get("sizes_line") or "", data.get("season_line") or "")
+    def cell(name: str) -> str:
+        idx = cols.get(name, len(cells))
+        return cells[idx] if idx < len(cells) else ""
+
+    price = parse_number_token(cell("price"))
+    retail = parse_number_token(cell("retail"))
+    if "sizes" in cols or "season" in cols:
+        # размеры/сезон лежат в своих колонках — полный разбор строки не нужен
+        sizes = cell("sizes")
+        sizes_line = sizes_memo.get(sizes)
+        if sizes_line is None:
+            sizes_line = sizes_memo[sizes] = (extract_sizes_anywhere(sizes) or sizes) if sizes else ""
+        season_line = cell("season")
+    else:
+        rest = [c for i, c in enumerate(cells) if c and i not in cols.values()]
+        data = parse_input("\n".join(rest)) if rest else {}
+        sizes_line, season_line = data.get("sizes_line") or "", data.get("season_line") or ""
+    return ImportRow(cells, price, _discount_cell(cell("discount")),
+                     retail if retail is not None else (price or 0.0), sizes_line, season_line)
+
+def reprice_document(data: bytes, filename: str, mode_key: str, with_cards: bool = False,
+                     calc_fn: Optional[Callable[[float, int], int]] = None) -> Dict[str, Any]:
+    """Разбор и пересчёт прайса целиком (в потоке): CSV-ответ, счётчики и, по запросу, карточки."""
+    fmt = _import_format(filename)
+    if fmt is None:
+        raise ValueError(f"неподдерживаемый формат: {filename}")
+    mode = MODES.get(mode_key, MODES["sale"])
+    rows: List[ImportRow] = []
+    header: List[str] = []
+    cols: Dict[str, int] = {}
+    sizes_memo: Dict[str, str] = {}  # в прайсе одни и те же сетки размеров повторяются
+    for cells in _iter_import_rows(data, fmt):
+        if not any(cells):
+            continue
+        if fmt != "txt" and not header and not rows:
+            cols = _import_columns(cells)
+            if cols:
+                header = cells
+                continue
+        rows.append(_import_row(cells, cols, sizes_memo))
+
+    priced = [r for r in rows if r.price is not None]
+    finals = calc_many(calc_fn or mode["calc"], [r.price for r in priced], [r.discount for r in priced])
+    final_of = {id(r): f for r, f in zip(priced, finals)}
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    width = max([len(header)] + [len(r.cells) for r in rows]) if rows else len(header)
+    if header or fmt == "txt":
+        writer.writerow((header or ["text"]) + [""] * (width - len(header or ["text"])) + ["final_price"])
+    for r in rows:
+        writer.writerow(r.cells + [""] * (width - len(r.cells)) + [final_of.get(id(r), "")])
+
+    cards = [mode["template"](final_price=final_of[id(r)], retail=r.retail, sizes_line=r.sizes_line,
+                              season_line=r.season_line, brand_line="")
+             for r in priced] if with_cards else []
+    return {
+        "csv": out.getvalue().encode("utf-8-sig"),
+        "cards": cards,
+        "rows": len(rows),
+        "priced": len(priced),
+        "label": mode["label"],
+    }
+
+@router.message(Command("import"), F.document)
+async def import_price_list(msg: Message):
+    """/import [режим] [publish] в подписи к CSV/XLSX/TXT."""
+    user_id = msg.from_user.id
+    if not is_admin(user_id):
+        return await msg.answer("⛔ Только для админов.")
+    doc = msg.document
+    args = [a.lstrip("/").lower() for a in (msg.caption or "").split()[1:]]
+    mode_key = next((a for a in args if a in MODES), _mode_key_for(user_id))
+    publish = any(a in _IMPORT_PUBLISH_ARGS for a in args)
+    filename = doc.file_name or "price.txt"
+    if _import_format(filename) is None:
+        hint = " (для XLSX нужен openpyxl)" if filename.lower().endswith((".xlsx", ".xlsm")) else ""
+        return await msg.answer(f"⚠️ Поддерживаются CSV, XLSX и TXT{hint}.")
+    if doc.file_size and doc.file_size > IMPORT_MAX_MB * 1024 * 1024:
+        return await msg.answer(f"⚠️ Файл больше {IMPORT_MAX_MB:g} МБ.")
+
+    buf = io.BytesIO()
+    await bot.download(doc, buf)
+    t0 = time.perf_counter()
+    try:
+        report = await asyncio.to_thread(reprice_document, buf.getvalue(), filename, mode_key, publish,
+                                         calc_for(user_id, mode_key))
+    except Exception as e:
+        print("IMPORT ERROR:", repr(e))
+        return await msg.answer("⚠️ Не смогла прочитать файл.")
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+    print("IMPORT:", filename, "rows", report["rows"], "priced", report["priced"], f"{elapsed_ms:.0f}ms")
+
+    stem = os.path.splitext(filename)[0]
+    await msg.answer_document(
+        BufferedInputFile(report["csv"], filename=f"{stem}_{mode_key}.csv"),
+        caption=(f"Режим <b>{report['label']}</b>: позиций {report['rows']}, с ценой {report['priced']}, "
+                 f"без цены {report['rows'] - report['priced']} ({elapsed_ms:.0f} мс)"),
+    )
+    if publish and len(report["cards"]) > IMPORT_PUBLISH_MAX:
+        # 100k строк — это ~10k сообщений и часы очереди витрины без возможности отменить
+        return await msg.answer(f"⚠️ Карточек {len(report['cards'])} — больше лимита {IMPORT_PUBLISH_MAX}, "
+                                f"в канал не публикую. Раздели прайс на части.")
+    if publish and report["cards"]:
+        cards = report["cards"]
+        item = [MediaItem(MediaKind.TEXT, msg.message_id, cap=True)]
+        # один seq на весь прайс — порядок внутри полосы держит счётчик вставки
+        for i in range(0, len(cards), IMPORT_PUBLISH_BATCH):
+            await publish_to_target(chat_id=msg.chat.id, first_mid=msg.message_id, user_id=user_id,
+                                    items=item, caption="\n".join(cards[i:i + IMPORT_PUBLISH_BATCH]).strip())
+        await msg.answer(f"В очереди на публикацию: {len(cards)} карточек.")
+
 # ====== ЗАПУСК ======
+# ====== ВОССТАНОВЛЕНИЕ ПОСЛЕ РЕСТАРТА ======
+_last_update_id = 0      # update_id, до которого включительно всё обработано, — пишется в state
+_restored_update_id = 0  # то же на момент старта: всё, что не новее, уже обработано до рестарта
+_inflight_updates: set = set()
+_done_update_id = 0
+
+@dp.update.outer_middleware()
+async def _dedupe_updates(handler, event: Update, data: Dict[str, Any]):
+    global _last_update_id, _done_update_id
+    # сравниваем с отметкой старта, а не с текущим максимумом: вебхук с несколькими
+    # соединениями может доставлять апдейты не строго по возрастанию
+    if event.update_id <= _restored_update_id:
+        return None
+    _inflight_updates.add(event.update_id)
+    _trace_id.set(new_trace_id())
+    try:
+        with trace_span("update", update_id=event.update_id, type=event.event_type):
+            return await handler(event, data)
+    finally:
+        # отметку двигаем только после обработчика (его записи уже в staged) и не дальше самого
+        # раннего незавершённого апдейта — иначе падение между flush и записями потеряет пост
+        _inflight_updates.discard(event.update_id)
+        _done_update_id = max(_done_update_id, event.update_id)
+        mark = min(_done_update_id, min(_inflight_updates) - 1) if _inflight_updates else _done_update_id
+        if mark > _last_update_id:
+            _last_update_id = mark
+            state.put("meta", "last_update_id", mark)
+
+def restore_state():
+    global _last_update_id, _restored_update_id
+    if not state.enabled:
+        return
+    _last_update_id = _restored_update_id = int(state.load("meta").get("last_update_id", 0))
+
+    for uid, mode in state.load("mode").items():
+        active_mode[int(uid)] = mode
+
+    for skey, formula in state.load("formula").items():
+        uid, mode_key = skey.split("|", 1)
+        try:
+            compile_formula(formula)
+        except ValueError as e:
+            print(f"STATE bad formula {skey}:", repr(e))
+            continue
+        mode_formulas[(int(uid), mode_key)] = formula
+
+    for cid, b in state.load("last_media").items():
+        bucket = last_media[int(cid)] = dict(b, ts=datetime.fromisoformat(b["ts"]), items=_items_from_state(b["items"]))
+        _arm_media_window(int(cid), bucket)
+
+    for skey, b in state.load("album").items():
+        cid, mgid = skey.split("|", 1)
+        key = (int(cid), mgid)
+        items = sorted(_items_from_state(b["items"]), key=mid_of)
+        buf = album_buffers[key] = dict(b, items=items, ocr_sem=asyncio.Semaphore(max(1, OCR_ALBUM_CONCURRENCY)))
+        album_index_update(key, buf)
+        if is_ocr_enabled_for(buf["user_id"]):
+            for it in buf["items"]:
+                _start_speculative_ocr(it, buf["ocr_sem"])
+        timers.schedule(("album", key), ALBUM_SETTLE_MS / 1000, lambda key=key: _flush_album(key))
+
+    for cid, recs in state.load("batch").items():
+        q = _get_q(int(cid))
+        for r in recs:
+            text_msg = Message.model_validate(r["text_msg"], context={"bot": bot}) if r["text_msg"] else None
+            rec = BatchRec(text_msg=text_msg, media=_items_from_state(r["media"]), user_id=r["user_id"])
+            q.append(rec)
+            _arm_batch_timer(int(cid), rec)
+
+    payloads = state.load("payload")
+    for pid, rec in sorted(payloads.items(), key=lambda kv: kv[1]["seq"]):
+        _enqueue_payload(dict(rec, items=_items_from_state(rec["items"])), pid)
+
+    print(f"STATE restored: modes {len(active_mode)}, formulas {len(mode_formulas)}, albums {len(album_buffers)}, "
+          f"pending media {len(last_media)}, batches {sum(len(q) for q in batches.values())}, "
+          f"payloads {len(payloads)}, last update {_last_update_id}")
+
+# ====== ВЕБХУК ======
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Отвечает Telegram 200, как только апдейт взят в обработку; в обработке — не больше WEBHOOK_MAX_INFLIGHT.
+    Слот занимается до создания задачи: когда все заняты, запрос просто ждёт ответа, и Telegram,
+    упёршись в max_connections, перестаёт слать новые — очередь не растёт в памяти."""
+    def __init__(self, *args, max_inflight: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._tasks: set = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _process(self, bot: Bot, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=bot, result=result)
+        except Exception as e:
+            print("WEBHOOK UPDATE ERROR:", repr(e))
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def close(self) -> None:
+        if self._tasks:  # даём начатым апдейтам доработать, их id уже не придут повторно
+            await asyncio.wait(self._tasks, timeout=10)
+        await super().close()
+
+async def _healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+async def _metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics_text(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    app.router.add_get("/healthz", _healthz)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, METRICS_PORT).start()
+    print(f"METRICS: listening on {WEBAPP_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+async def run_webhook(drop_pending: bool):
+    # без проверки секрета публичный адрес принял бы апдейты от кого угодно — не задан, генерируем;
+    # set_webhook ниже вызывается при каждом запуске, так что Telegram получит тот же
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    if not WEBHOOK_SECRET:
+        print("WEBHOOK: WEBHOOK_SECRET не задан — используется случайный секрет на этот запуск")
+    app = web.Application()
+    handler = BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=secret,
+                                    max_inflight=WEBHOOK_MAX_INFLIGHT)
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", _healthz)  # для балансировщика / health check Render
+    app.router.add_get("/metrics", _metrics)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    # только один инстанс: буферы альбомов, режимы и state (SQLite) живут в процессе
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=drop_pending,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    print(f"WEBHOOK: listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    asyncio.create_task(publish_worker())
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    state.open()
+    restore_state()
+    flusher = asyncio.create_task(state.run())
+    sweeper = asyncio.create_task(stores_sweeper())
+    # без state очередь апдейтов сбрасываем, как раньше; с ним — дочитываем пропущенное за рестарт
+    drop_pending = not state.enabled
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(drop_pending)
+        else:
+            metrics_runner = await start_metrics_server() if METRICS_PORT > 0 else None
+            await bot.delete_webhook(drop_pending_updates=drop_pending)
+            try:
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            finally:
+                if metrics_runner:
+                    await metrics_runner.cleanup()
+    finally:
+        flusher.cancel()
+        sweeper.cancel()
+        ocr_shutdown()
+        await state.flush()
 
 if __name__ == "__main__":
     asyncio.run(main())
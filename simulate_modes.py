@@ -0,0 +1,191 @@
+# simulate_modes.py — «что будет, если»: пересчитать архив подписей всеми режимами разом
+# и показать, как изменятся цены. Разбор (parse_input) — один раз на уникальную подпись,
+# в нескольких процессах; расчёт — массивами NumPy через bot.calc_many.
+#
+#   python simulate_modes.py archive.jsonl                        # сводка по всем режимам против sale
+#   python simulate_modes.py archive.jsonl --formula "lux=-%; ≤250 +55; ≤400 +80; +10% +30"
+#   python simulate_modes.py archive.jsonl --formula "-%; ≤300 +60; +90" --top 20
+#   python simulate_modes.py archive.jsonl --csv diff.csv --workers 4
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from typing import Callable, Dict, List, Sequence, Tuple
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("OCR_ENABLED", "0")
+os.environ.setdefault("STATE_PATH", "")
+
+import bot  # noqa: E402
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ARCHIVE = os.path.join(HERE, "bench_captions.jsonl")
+PARSE_CHUNK = 256
+
+Position = Tuple[float, int]  # (цена, скидка) одной позиции
+
+def load_archive(path: str, field: str) -> Tuple[List[str], List[str]]:
+    ids: List[str] = []
+    captions: List[str] = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if rec.get(field):
+                ids.append(str(rec.get("id", n)))
+                captions.append(rec[field])
+    return ids, captions
+
+# ---------- разбор ----------
+def parse_positions(caption: str) -> List[Position]:
+    """Позиции так же, как их видит build_result_text: блоки прайса или вся подпись целиком."""
+    out: List[Position] = []
+    for block in bot._split_positions(caption) or [caption]:
+        data = bot.parse_input_cached(block)  # одни и те же позиции кочуют из прайса в прайс
+        if data.get("price") is not None:
+            out.append((float(data["price"]), int(data.get("discount") or 0)))
+    return out
+
+def _parse_chunk(captions: Sequence[str]) -> List[List[Position]]:
+    return [parse_positions(c) for c in captions]
+
+def parse_unique(captions: Sequence[str], workers: int) -> Dict[str, List[Position]]:
+    unique = list(dict.fromkeys(captions))  # репосты и повторы разбираем один раз
+    chunks = [unique[i:i + PARSE_CHUNK] for i in range(0, len(unique), PARSE_CHUNK)]
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            parsed = [p for chunk in pool.imap(_parse_chunk, chunks) for p in chunk]
+    else:
+        parsed = [p for chunk in chunks for p in _parse_chunk(chunk)]
+    return dict(zip(unique, parsed))
+
+# ---------- расчёт ----------
+def parse_formula_args(values: Sequence[str]) -> Dict[str, str]:
+    """«mode=правило» — для одного режима, просто «правило» — для всех (ключ "*")."""
+    out: Dict[str, str] = {}
+    for v in values or ():
+        mode, sep, rule = v.partition("=")
+        if sep and mode.strip() in bot.MODES:
+            out[mode.strip()] = rule
+        else:
+            out["*"] = v
+    return out
+
+def evaluate(calcs: Dict[str, Callable[[float, int], int]], prices, discounts) -> Dict[str, "np.ndarray"]:
+    """Каждая уникальная функция считается один раз: 35 режимов сейчас делят две."""
+    by_fn: Dict[Callable, "np.ndarray"] = {}
+    out: Dict[str, "np.ndarray"] = {}
+    for mode, fn in calcs.items():
+        if fn not in by_fn:
+            by_fn[fn] = np.asarray(bot.calc_many(fn, prices, discounts), dtype=np.int64)
+        out[mode] = by_fn[fn]
+    return out
+
+def summarize(cur: "np.ndarray", new: "np.ndarray") -> Dict[str, float]:
+    delta = new - cur
+    changed = np.count_nonzero(delta)
+    return {
+        "mean": float(new.mean()) if len(new) else 0.0,
+        "changed": int(changed),
+        "delta_mean": float(delta.mean()) if len(delta) else 0.0,
+        "delta_min": int(delta.min()) if len(delta) else 0,
+        "delta_max": int(delta.max()) if len(delta) else 0,
+        "delta_pct": float((delta / np.maximum(cur, 1)).mean() * 100) if len(delta) else 0.0,
+    }
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Пересчёт архива подписей всеми режимами и сравнение цен")
+    ap.add_argument("archive", nargs="?", default=DEFAULT_ARCHIVE, help="JSONL с подписями")
+    ap.add_argument("--field", default="caption", help="поле с текстом подписи")
+    ap.add_argument("--baseline", default="sale", help="с каким режимом сравнивать без --formula")
+    ap.add_argument("--formula", action="append", help="«mode=правило» или «правило» для всех режимов (как в /formula)")
+    ap.add_argument("--modes", help="только эти режимы, через запятую")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="процессов для разбора")
+    ap.add_argument("--top", type=int, default=0, help="показать N самых больших изменений")
+    ap.add_argument("--csv", help="записать цены по каждой позиции в CSV")
+    args = ap.parse_args(argv)
+
+    if np is None:
+        print("Нужен numpy: pip install numpy")
+        return 2
+    modes = [m.strip() for m in args.modes.split(",")] if args.modes else list(bot.MODES)
+    unknown = [m for m in modes + [args.baseline] if m not in bot.MODES]
+    if unknown:
+        print(f"Нет таких режимов: {', '.join(unknown)}")
+        return 2
+    try:
+        overrides = {m: bot.compile_formula(rule) for m, rule in parse_formula_args(args.formula).items()}
+    except ValueError as e:
+        print(f"Формула: {e}")
+        return 2
+
+    t0 = time.perf_counter()
+    ids, captions = load_archive(args.archive, args.field)
+    parsed = parse_unique(captions, args.workers)
+    t_parse = time.perf_counter() - t0
+
+    owners: List[int] = []
+    prices: List[float] = []
+    discounts: List[int] = []
+    for idx, cap in enumerate(captions):
+        for price, discount in parsed[cap]:
+            owners.append(idx)
+            prices.append(price)
+            discounts.append(discount)
+
+    t1 = time.perf_counter()
+    current = evaluate({m: bot.MODES[m]["calc"] for m in set(modes) | {args.baseline}}, prices, discounts)
+    what_if = evaluate({m: overrides.get(m) or overrides["*"] for m in modes if m in overrides or "*" in overrides},
+                       prices, discounts)
+    t_calc = time.perf_counter() - t1
+
+    print(f"Архив: {len(captions)} подписей ({len(parsed)} уникальных), позиций с ценой {len(prices)}, "
+          f"без цены {sum(1 for c in captions if not parsed[c])}")
+    print(f"Разбор {t_parse:.2f} с ({args.workers} проц.), расчёт {t_calc * 1000:.0f} мс\n")
+    against = "формула" if what_if else args.baseline
+    print(f"{'режим':<10}{'ср. цена':>10}{'изменится':>11}{'Δ ср.':>9}{'Δ мин':>8}{'Δ макс':>8}{'Δ %':>8}   против: {against}")
+    for m in modes:
+        if what_if:  # режим без новой формулы не меняется
+            cur, new = current[m], what_if.get(m, current[m])
+        else:
+            cur, new = current[args.baseline], current[m]
+        s = summarize(cur, new)
+        print(f"{m:<10}{s['mean']:>10.1f}{s['changed']:>11}{s['delta_mean']:>9.1f}"
+              f"{s['delta_min']:>8}{s['delta_max']:>8}{s['delta_pct']:>8.1f}")
+
+    if args.top and what_if:
+        print(f"\nСамые большие изменения (top {args.top}):")
+        seen = set()
+        for m in modes:
+            pair = (id(current[m]), id(what_if.get(m)))
+            if m not in what_if or pair in seen:  # режимы с одной и той же парой функций — один раз
+                continue
+            seen.add(pair)
+            delta = what_if[m] - current[m]
+            for i in np.argsort(-np.abs(delta), kind="stable")[:args.top]:
+                if delta[i]:
+                    print(f"  {m:<8} {ids[owners[i]]:<16} {prices[i]:>9.2f}€ -{discounts[i]}%: "
+                          f"{current[m][i]} → {what_if[m][i]} ({delta[i]:+d})")
+
+    if args.csv:
+        with open(args.csv, "w", encoding="utf-8-sig", newline="") as f:
+            w = csv.writer(f)
+            cols = [(m, current[m]) for m in modes] + [(f"{m}_new", what_if[m]) for m in modes if m in what_if]
+            w.writerow(["id", "price", "discount"] + [name for name, _ in cols])
+            for i in range(len(prices)):
+                w.writerow([ids[owners[i]], prices[i], discounts[i]] + [int(arr[i]) for _, arr in cols])
+        print(f"\nПодробности: {args.csv}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())